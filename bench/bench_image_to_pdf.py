@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""صورة → PDF: حفظ Pillow (فك وإعادة ترميز) مقابل _image_to_pdf (تضمين JPEG/PNG كما هو).
+
+نقيس الزمن وحجم الناتج لصورة هاتف 12MP (JPEG) ولقطة شاشة (PNG)، ونتحقق أن JPEG ضُمِّن
+بترميزه الأصلي.
+
+    python bench/bench_image_to_pdf.py [image ...] [--repeat N]
+"""
+
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import fitz  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from cpu_tasks import _image_to_pdf  # noqa: E402
+
+def sample_images(d: Path) -> list:
+    # ضوضاء مكبّرة: تفاصيل ناعمة تشبه الصورة الحقيقية فلا يضغطها JPEG إلى لا شيء
+    noise = Image.merge("RGB", [Image.effect_noise((400, 300), 64) for _ in range(3)])
+    photo = d / "phone.jpg"
+    noise.resize((4000, 3000), Image.BICUBIC).save(photo, quality=88)
+    shot = d / "screen.png"
+    noise.resize((1170, 2532), Image.NEAREST).save(shot)
+    return [photo, shot]
+
+def pillow_pdf(in_path: Path, out_path: Path):
+    with Image.open(in_path) as im:
+        im.save(out_path, "PDF")
+
+def bench(fn, src: Path, out: Path, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(src, out)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+def main():
+    args = sys.argv[1:]
+    repeat = 5
+    if "--repeat" in args:
+        i = args.index("--repeat")
+        repeat = int(args[i + 1])
+        del args[i:i + 2]
+    with tempfile.TemporaryDirectory() as tmp:
+        d = Path(tmp)
+        images = [Path(a) for a in args] or sample_images(d)
+        for src in images:
+            print(f"{src.name}: {src.stat().st_size / 1e6:.2f}MB")
+            for name, fn in (("pillow", pillow_pdf), ("_image_to_pdf", _image_to_pdf)):
+                out = d / f"{src.stem}_{name}.pdf"
+                dt = bench(fn, src, out, repeat)
+                print(f"  {name:<14} {dt * 1000:7.0f}ms  {out.stat().st_size / 1e6:6.2f}MB")
+            with fitz.open(d / f"{src.stem}__image_to_pdf.pdf") as doc:
+                xref = doc.get_page_images(0)[0][0]
+                print(f"  embedded as: {doc.extract_image(xref)['ext']}")
+
+if __name__ == "__main__":
+    main()
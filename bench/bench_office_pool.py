@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""office_to_pdf: soffice لكل مستند (OFFICE_WORKERS=0) مقابل مجمّع العمليات الدافئة (OFFICE_WORKERS=2).
+
+لكل وضع: زمن أول مستند (يشمل تشغيل المجمّع)، ثم متوسط N مستند متتالية، ثم N مستند متزامنة.
+يحتاج soffice، وبايثون النظام مع وحدة uno (OFFICE_PYTHON) للوضع الدافئ.
+
+    python bench/bench_office_pool.py [document] [N]
+"""
+
+import asyncio
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+
+def sample_document(d: Path) -> Path:
+    p = d / "sample.rtf"
+    para = r"\par Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40
+    p.write_text(r"{\rtf1\ansi{\fonttbl\f0 Times;}\f0\fs24 " + para * 20 + "}")
+    return p
+
+async def convert(src: Path, d: Path, i: int) -> float:
+    job = d / f"job{i}"
+    job.mkdir()
+    doc = job / src.name
+    shutil.copy(src, doc)
+    t0 = time.perf_counter()
+    await bot.office_to_pdf(doc, job / "out.pdf")
+    return time.perf_counter() - t0
+
+async def run(workers: int, src: Path, n: int) -> None:
+    bot.OFFICE_POOL = bot.OfficePool(workers)
+    d = Path(tempfile.mkdtemp(prefix="bench_office_"))
+    try:
+        first = await convert(src, d, 0)
+        seq = [await convert(src, d, i) for i in range(1, n + 1)]
+        t0 = time.perf_counter()
+        await asyncio.gather(*(convert(src, d, i) for i in range(n + 1, 2 * n + 1)))
+        par = time.perf_counter() - t0
+        warm = "warm pool" if bot.OFFICE_POOL.available else "soffice per document"
+        print(f"OFFICE_WORKERS={workers} ({warm}): first {first:.2f}s | sequential avg {statistics.mean(seq):.2f}s"
+              f" (p50 {statistics.median(seq):.2f}s) | {n} concurrent {par:.2f}s")
+    finally:
+        await bot.OFFICE_POOL.shutdown()
+        shutil.rmtree(d, ignore_errors=True)
+
+async def main():
+    if not bot.BIN["soffice"]:
+        raise SystemExit("soffice not found")
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(sys.argv[1]) if len(sys.argv) > 1 else sample_document(Path(tmp))
+        print(f"document={src.name} ({src.stat().st_size // 1024}KB) N={n}")
+        for workers in (0, 2):
+            await run(workers, src, n)
+
+if __name__ == "__main__":
+    asyncio.run(main())
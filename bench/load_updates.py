@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""حمل على UserOrderedUpdateProcessor بتحديثات مزيفة: الإنتاجية مقابل CONC_UPDATES.
+
+كل تحديث ينتظر HANDLER_MS (معالج محكوم بالإدخال/الإخراج مثل طلب لتيليجرام). نتحقق أيضاً
+أن تحديثات المستخدم الواحد تُنفَّذ بترتيب وصولها.
+
+    python bench/load_updates.py [users] [updates_per_user]
+"""
+
+import asyncio
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram import Chat, Message, Update, User  # noqa: E402
+
+from bot import UserOrderedUpdateProcessor  # noqa: E402
+
+HANDLER_MS = 20
+
+def fake_update(uid: int, n: int) -> Update:
+    user = User(uid, f"u{uid}", False)
+    msg = Message(n, datetime.now(timezone.utc), Chat(uid, Chat.PRIVATE), from_user=user, text=str(n))
+    return Update(uid * 100000 + n, message=msg)
+
+async def run(conc: int, users: int, per_user: int) -> tuple:
+    proc = UserOrderedUpdateProcessor(conc)
+    seen = {u: [] for u in range(1, users + 1)}
+
+    async def handler(uid: int, n: int):
+        await asyncio.sleep(HANDLER_MS / 1000)
+        seen[uid].append(n)
+
+    t0 = time.perf_counter()
+    tasks = []
+    for n in range(per_user):
+        for uid in seen:
+            tasks.append(asyncio.ensure_future(proc.process_update(fake_update(uid, n), handler(uid, n))))
+            await asyncio.sleep(0)   # ترتيب الوصول كما في المُحضِر
+    await asyncio.gather(*tasks)
+    dt = time.perf_counter() - t0
+    ordered = all(v == list(range(per_user)) for v in seen.values())
+    return len(tasks) / dt, ordered
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"users={users} updates/user={per_user} handler={HANDLER_MS}ms")
+    for conc in (1, 4, 16, 64, 256):
+        rate, ordered = await run(conc, users, per_user)
+        print(f"CONC_UPDATES={conc:<4} {rate:8.1f} updates/s  per-user order kept: {ordered}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
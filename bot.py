@@ -2,23 +2,39 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
+import fcntl
+import functools
+import hashlib
+import heapq
+import ipaddress
 import json
 import logging
 import os
 import re
 import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
 import tempfile
 import threading
-from dataclasses import dataclass
+import time
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing.connection import Connection
 from pathlib import Path
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import unquote, urljoin, urlparse
 
+import httpcore
 import httpx
-import fitz  # PyMuPDF
-from pdf2image import convert_from_path
-from pdf2docx import parse as pdf2docx_parse
-from PIL import Image
+from aiohttp import web
 from telegram import (
     Update,
     InlineKeyboardMarkup,
@@ -29,16 +45,37 @@ from telegram import (
     BotCommand,
 )
 from telegram.constants import ChatAction, ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import (
     Application,
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
+    ChatMemberHandler,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
 
+import cpu_tasks
+from cpu_tasks import (
+    _apply_image_replacements,
+    _compress_image,
+    _fitz_deflate,
+    _image_convert,
+    _image_to_pdf,
+    _merge_pdfs,
+    _pdf2docx_make,
+    _pdf2docx_parse_range,
+    _pdf_image_plan,
+    _pdf_page_count,
+    _pdf_scan,
+    _recompress_images,
+    _render_pdf_range,
+)
+
 # ================= إعدادات عامة =================
 
 logging.basicConfig(
@@ -57,6 +94,9 @@ PORT = int(os.getenv("PORT", os.getenv("WEB_CONCURRENCY", "10000")))
 
 # MODE: webhook | polling
 MODE = (os.getenv("MODE", "").strip().lower() or ("webhook" if PUBLIC_URL else "polling"))
+# /metrics يُخدم على PORT نفسه في الوضعين؛ METRICS_PORT منفذ إضافي اختياري (0 = بلا)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))   # العامل المحلي n يأخذ المنفذ + n
 
 # حدود تيليجرام
 TG_LIMIT_MB = int(os.getenv("TG_LIMIT_MB", "49"))                 # حد الإرسال
@@ -65,37 +105,360 @@ TG_DL_LIMIT_MB = int(os.getenv("TG_DL_LIMIT_MB", "20"))           # حد الت
 TG_DL_LIMIT = TG_DL_LIMIT_MB * 1024 * 1024
 
 # التوازي
-CONC_IMAGE = int(os.getenv("CONC_IMAGE", "20"))
-CONC_PDF   = int(os.getenv("CONC_PDF", "20"))
-CONC_MEDIA = int(os.getenv("CONC_MEDIA", "20"))
-CONC_OFFICE= int(os.getenv("CONC_OFFICE", "20"))
+CONC_UPDATES = int(os.getenv("CONC_UPDATES", "64"))             # تحديثات تُعالج بالتوازي (تسلسلية لكل مستخدم)
+
+# عمّال الطابور على نفس الجهاز: البوت يضبطهما لكل عامل محلي (1..N) حتى لا تتصادم منافذ
+# LibreOffice وملفات تعريفه، وتُقسم سعة الجهاز بينهم. العامل الخارجي على نفس الجهاز يضبطهما يدوياً.
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_SHARE = max(1, int(os.getenv("WORKER_SHARE", "1")))     # عمليات تتقاسم هذا الجهاز
+
+# المجدول: سعة بوحدات CPU (افتراضياً عدد الأنوية) وذاكرة بالميغابايت (افتراضياً 75% من RAM)،
+# للجهاز كله: تُقسم على WORKER_SHARE
+def _default_mem_mb() -> int:
+    try:
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.75) // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 2048
+
+SCHED_CPU_UNITS = max(1.0, (float(os.getenv("SCHED_CPU_UNITS", "0") or 0) or float(os.cpu_count() or 2)) / WORKER_SHARE)
+SCHED_MEM_MB = max(256, (int(os.getenv("SCHED_MEM_MB", "0") or 0) or _default_mem_mb()) // WORKER_SHARE)
+
+# مجمّع عمليات المعالج (Pillow/PyMuPDF/pdf2docx): process أو thread؛ العدد للجهاز كله
+CPU_WORKERS = max(1, (int(os.getenv("CPU_WORKERS", "0") or 0) or (os.cpu_count() or 2)) // WORKER_SHARE)
+CPU_POOL_MODE = os.getenv("CPU_POOL_MODE", "process").strip().lower()
+
+# تنزيل مسبق تخميني بعد N ثانية من وصول الملف (0 = معطّل؛ التنزيل يبدأ عند اختيار القسم)
+PREFETCH_DELAY = float(os.getenv("PREFETCH_DELAY", "0") or 0)
+
+# PDF → DOCX: نطاقات صفحات تُحلَّل بالتوازي، مع سقف للصفحات وللزمن (ينتج ملفاً جزئياً بدل التعليق)
+PDF2DOCX_CHUNK = int(os.getenv("PDF2DOCX_CHUNK", "10"))
+PDF2DOCX_MAX_PAGES = int(os.getenv("PDF2DOCX_MAX_PAGES", "300"))  # 0 = بلا سقف
+PDF2DOCX_TIMEOUT = int(os.getenv("PDF2DOCX_TIMEOUT", "900"))
+
+# أقل فاصل (ثوانٍ) بين تعديلات رسالة التقدم؛ تيليجرام يقيّد تعديل الرسالة نفسها
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "4"))
+
+# ضغط PDF: عدد الاستراتيجيات التي تعمل معاً لكل ملف
+PDF_PARALLEL = int(os.getenv("PDF_PARALLEL", "0") or 0) or min(3, os.cpu_count() or 1)
+
+# الألبومات: تجميع رسائل media_group_id الواحدة في مهمة واحدة
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.5"))            # ثوانٍ انتظار بعد آخر عنصر
+
+# كنس المهام والملفات المؤقتة
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))                       # ثوانٍ قبل انتهاء صلاحية مهمة خاملة
+GC_INTERVAL = int(os.getenv("GC_INTERVAL", "60"))
+GC_ORPHAN_AGE = int(os.getenv("GC_ORPHAN_AGE", "900"))           # عمر المجلد اليتيم قبل حذفه
+GC_MIN_FREE_MB = int(os.getenv("GC_MIN_FREE_MB", "1024"))        # تحت هذا الحد نحذف الأقدم أولاً
+
+# الإرسال لتيليجرام: ~30 رسالة/ث إجمالاً و~1/ث لكل محادثة، مع طابور محدود وأولوية لتعديلات الحالة
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_OUT_CONC = int(os.getenv("TG_OUT_CONC", "8"))
+TG_UPLOAD_CONC = int(os.getenv("TG_UPLOAD_CONC", "4"))
+TG_OUT_QUEUE = int(os.getenv("TG_OUT_QUEUE", "500"))
+TG_SEND_RETRIES = int(os.getenv("TG_SEND_RETRIES", "4"))
+
+# الحالة المشتركة (المهام، اللغات، العدادات): "" = ذاكرة العملية، sqlite:///path، أو redis://…
+STATE_URL = os.getenv("STATE_URL", "").strip()
+
+# طابور العمل الدائم: مسار SQLite يفعّله؛ التحويل يجري في عمليات "python bot.py worker" منفصلة
+WORK_QUEUE_DB = os.getenv("WORK_QUEUE_DB", "").strip()
+WORK_WORKERS = int(os.getenv("WORK_WORKERS", "1"))              # عمّال محليون يشغّلهم البوت (0 = خارجيون فقط)
+WORK_CONC = int(os.getenv("WORK_CONC", "4"))                    # مهام متزامنة لكل عامل
+WORK_LEASE = int(os.getenv("WORK_LEASE", "60"))                 # مهمة بلا نبض لهذه المدة تُعاد لعامل آخر
+WORK_MAX_ATTEMPTS = int(os.getenv("WORK_MAX_ATTEMPTS", "3"))
+WORK_POLL = float(os.getenv("WORK_POLL", "0.5"))
+
+# كاش عضوية القناة: مدة الحالة الإيجابية، ومدة قصيرة للسلبية حتى لا ينتظر من اشترك للتو
+MEMBER_TTL = int(os.getenv("MEMBER_TTL", "600"))
+MEMBER_NEG_TTL = int(os.getenv("MEMBER_NEG_TTL", "30"))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "50000"))
+LANG_TTL = int(os.getenv("LANG_TTL", "300"))                   # كاش لغة المستخدم المحلي (تغييرها من نسخة أخرى يصل بعدها)
+
+# كاش النتائج: file_id الناتج المرفوع مسبقاً لكل (ملف، عملية، معاملات)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "5000"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+RESULT_CACHE_DB = os.getenv("RESULT_CACHE_DB", "").strip()       # مسار SQLite اختياري للطبقة الدائمة
+
+# PDF → صور
+PDF_IMG_DPI = int(os.getenv("PDF_IMG_DPI", "200"))
+PDF_IMG_CHUNK = int(os.getenv("PDF_IMG_CHUNK", "8"))             # أقل عدد صفحات لكل عامل
+
+# LibreOffice: عمليات soffice دائمة يُخاطَب كلٌّ منها عبر UNO على منفذ محلي
+OFFICE_WORKERS = int(os.getenv("OFFICE_WORKERS", "2"))          # 0 = تشغيل soffice لكل مستند
+OFFICE_MAX_JOBS = int(os.getenv("OFFICE_MAX_JOBS", "50"))        # إعادة تشغيل العامل بعد N مستند
+OFFICE_TIMEOUT = int(os.getenv("OFFICE_TIMEOUT", "180"))
+OFFICE_BASE_PORT = int(os.getenv("OFFICE_BASE_PORT", "2202"))   # العامل i يأخذ OFFICE_WORKERS منفذاً بعد i*OFFICE_WORKERS
+OFFICE_PYTHON = os.getenv("OFFICE_PYTHON", "/usr/bin/python3")   # بايثون النظام الذي يملك وحدة uno
+OFFICE_ROOT = Path("/tmp/convbot_lo") / f"w{WORKER_INDEX}"      # خارج WORK_ROOT حتى لا يكنسه الـ GC
+
+# تنزيل الروابط المباشرة (يتجاوز حد تنزيل تيليجرام)
+URL_MAX_MB = int(os.getenv("URL_MAX_MB", str(TG_LIMIT_MB)))
+URL_MAX = URL_MAX_MB * 1024 * 1024
+URL_RETRIES = int(os.getenv("URL_RETRIES", "3"))                 # محاولات الاستئناف عبر Range
+URL_ALLOW_PRIVATE = os.getenv("URL_ALLOW_PRIVATE", "0") == "1"   # السماح بعناوين الشبكة الداخلية
 
 # PDF.co اختياري
 PDFCO_API_KEY = os.getenv("PDFCO_API_KEY", "").strip()
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))               # إعادة المحاولة لطلبات HTTP الخارجية
 
-WORK_ROOT = Path("/tmp/convbot")
+# كل نسخة من البوت تعمل في مجلد خاص تحت WORK_BASE يحميه قفل ملف طوال حياتها، فلا يكنس GC نسخةٍ
+# ملفاتِ نسخة أخرى على نفس الجهاز. العمّال وعمليات المجمّع يرثون مجلد واجهتهم عبر البيئة.
+WORK_BASE = Path("/tmp/convbot")
+WORK_ROOT = Path(os.getenv("CONVBOT_WORK_ROOT", "") or WORK_BASE / f"r{os.getpid()}")
 WORK_ROOT.mkdir(parents=True, exist_ok=True)
+os.environ["CONVBOT_WORK_ROOT"] = WORK_ROOT.as_posix()
+_WORK_LOCK = None   # مقبض القفل يبقى مفتوحاً ما دامت الواجهة حيّة
+
+def claim_work_root() -> None:
+    global _WORK_LOCK
+    _WORK_LOCK = open(WORK_ROOT / ".lock", "w")
+    fcntl.flock(_WORK_LOCK, fcntl.LOCK_EX | fcntl.LOCK_NB)
 
 # برامج النظام
 BIN = {
     "soffice": shutil.which("soffice"),
-    "pdftoppm": shutil.which("pdftoppm"),
     "ffmpeg": shutil.which("ffmpeg"),
+    "ffprobe": shutil.which("ffprobe"),
     "gs": shutil.which("gs"),
 }
-log.info("[bin] soffice=%s, pdftoppm=%s, ffmpeg=%s, gs=%s (limit=%dMB)",
-         BIN["soffice"], BIN["pdftoppm"], BIN["ffmpeg"], BIN["gs"], TG_LIMIT_MB)
+log.info("[bin] soffice=%s, ffmpeg=%s, gs=%s (limit=%dMB)",
+         BIN["soffice"], BIN["ffmpeg"], BIN["gs"], TG_LIMIT_MB)
 
 SAFE_CHARS = re.compile(r"[^A-Za-z0-9_.\- ]+")
 
-# لغات
-USER_LANG: Dict[int, str] = {}
+# ======== مخزن الحالة المشترك ========
+# واجهة جزئية من redis-py (get/set/delete/incr/sadd/scard) حتى يعمل عميل Redis الحقيقي مكان البدائل المحلية،
+# وتتشارك عدة نسخ من البوت المهام والتفضيلات والعدادات، وتبقى بعد إعادة التشغيل.
+
+class MemoryState:
+    """الافتراضي: ذاكرة العملية (السلوك السابق)."""
+
+    def __init__(self):
+        self._kv: Dict[str, Tuple[str, float]] = {}   # key -> (value, expires أو 0)
+        self._sets: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[str]:
+        ent = self._kv.get(name)
+        if ent is None:
+            return None
+        if ent[1] and ent[1] <= time.time():
+            self._kv.pop(name, None)
+            return None
+        return ent[0]
+
+    def set(self, name: str, value, ex: Optional[int] = None) -> bool:
+        self._kv[name] = (str(value), time.time() + ex if ex else 0.0)
+        return True
 
-# Semaphores
-SEM_IMAGE = asyncio.Semaphore(CONC_IMAGE)
-SEM_PDF   = asyncio.Semaphore(CONC_PDF)
-SEM_MEDIA = asyncio.Semaphore(CONC_MEDIA)
-SEM_OFFICE= asyncio.Semaphore(CONC_OFFICE)
+    def delete(self, *names: str) -> int:
+        return sum(self._kv.pop(n, None) is not None for n in names)
+
+    def incr(self, name: str, amount: int = 1) -> int:
+        with self._lock:
+            ent = self._kv.get(name)
+            value = int(ent[0] if ent else 0) + amount
+            self._kv[name] = (str(value), ent[1] if ent else 0.0)
+            return value
+
+    def sadd(self, name: str, *values) -> int:
+        s = self._sets.setdefault(name, set())
+        before = len(s)
+        s.update(str(v) for v in values)
+        return len(s) - before
+
+    def scard(self, name: str) -> int:
+        return len(self._sets.get(name, ()))
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        dead = [k for k, (_, exp) in self._kv.items() if exp and exp <= now]
+        return self.delete(*dead)
+
+class SqliteState:
+    """SQLite بوضع WAL: عدة عمليات على نفس الجهاز تقرأ وتكتب معاً، والحالة تبقى بعد إعادة التشغيل."""
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sets (name TEXT, member TEXT, PRIMARY KEY (name, member))")
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT value, expires FROM kv WHERE key = ?", (name,)).fetchone()
+        if row is None or (row[1] and row[1] <= time.time()):
+            return None
+        return row[0]
+
+    def set(self, name: str, value, ex: Optional[int] = None) -> bool:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                             (name, str(value), time.time() + ex if ex else 0.0))
+        return True
+
+    def delete(self, *names: str) -> int:
+        with self._lock:
+            return sum(self._db.execute("DELETE FROM kv WHERE key = ?", (n,)).rowcount for n in names)
+
+    def incr(self, name: str, amount: int = 1) -> int:
+        # عبارة واحدة: ذرية حتى بين العمليات المختلفة
+        with self._lock:
+            row = self._db.execute(
+                "INSERT INTO kv (key, value, expires) VALUES (?, ?, 0) "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + excluded.value "
+                "RETURNING value", (name, amount),
+            ).fetchone()
+        return int(row[0])
+
+    def sadd(self, name: str, *values) -> int:
+        with self._lock:
+            return sum(self._db.execute("INSERT OR IGNORE INTO sets (name, member) VALUES (?, ?)",
+                                        (name, str(v))).rowcount for v in values)
+
+    def scard(self, name: str) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM sets WHERE name = ?", (name,)).fetchone()[0]
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._db.execute("DELETE FROM kv WHERE expires > 0 AND expires <= ?", (time.time(),)).rowcount
+
+def open_state(url: str):
+    if not url or url == "memory":
+        return MemoryState()
+    if url.startswith("sqlite:///"):
+        return SqliteState(url[len("sqlite:///"):])   # sqlite:////abs/path أو sqlite:///relative
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        try:
+            import redis
+        except ImportError:
+            raise SystemExit("STATE_URL يشير إلى Redis لكن الحزمة redis غير مثبتة")
+        return redis.Redis.from_url(url, decode_responses=True)
+    raise SystemExit(f"STATE_URL غير مدعوم: {url}")
+
+STATE = open_state(STATE_URL)
+log.info("[state] backend=%s", type(STATE).__name__)
+
+# ======== المقاييس (صيغة Prometheus النصية) ========
+
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.25, 1.5, 2.0)
+
+class Metrics:
+    """عدادات ومدرّجات تُكتب من حلقة الأحداث وتُقرأ من خيط خادم /metrics.
+    المقاييس المحسوبة من حالة تملكها الحلقة (قواميس المجدول والمهام…) تُجمع على الحلقة نفسها."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str]] = {}           # name -> (type, help)
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._hists: Dict[str, Tuple[tuple, Dict[tuple, list]]] = {}
+        self._callbacks: list = []                             # (name, type, help, fn -> [(labels, value)], on_loop)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def counter(self, name: str, help: str) -> None:
+        self._meta[name] = ("counter", help)
+        self._counters.setdefault(name, {})
+
+    def histogram(self, name: str, help: str, buckets: tuple = STAGE_BUCKETS) -> None:
+        self._meta[name] = ("histogram", help)
+        self._hists.setdefault(name, (buckets, {}))
+
+    def callback(self, name: str, kind: str, help: str, fn, on_loop: bool = True) -> None:
+        # قيم تُحسب عند القراءة من حالة موجودة أصلاً (المجدول، الكاش…)؛
+        # on_loop=False لما هو آمن من أي خيط (ملفات، SQLite بقفل) ولا يصح أن يحجز الحلقة
+        self._callbacks.append((name, kind, help, fn, on_loop))
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        buckets, series = self._hists[name]
+        with self._lock:
+            h = series.get(key)
+            if h is None:
+                h = series[key] = [0] * (len(buckets) + 2)    # عدّادات الحدود، المجموع، العدد
+            for i, b in enumerate(buckets):
+                if value <= b:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @staticmethod
+    def _labels(key, extra: tuple = ()) -> str:
+        items = list(key) + list(extra)
+        if not items:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self) -> str:
+        out = []
+        with self._lock:
+            for name, series in self._counters.items():
+                out += [f"# HELP {name} {self._meta[name][1]}", f"# TYPE {name} counter"]
+                out += [f"{name}{self._labels(k)} {v}" for k, v in series.items()]
+            for name, (buckets, series) in self._hists.items():
+                out += [f"# HELP {name} {self._meta[name][1]}", f"# TYPE {name} histogram"]
+                for k, h in series.items():
+                    out += [f"{name}_bucket{self._labels(k, (('le', b),))} {h[i]}" for i, b in enumerate(buckets)]
+                    out.append(f"{name}_bucket{self._labels(k, (('le', '+Inf'),))} {h[-1]}")
+                    out.append(f"{name}_sum{self._labels(k)} {h[-2]}")
+                    out.append(f"{name}_count{self._labels(k)} {h[-1]}")
+        values = self._collect([c for c in self._callbacks if not c[4]])
+        values.update(self._collect_on_loop([c for c in self._callbacks if c[4]]))
+        for name, kind, help, _, _ in self._callbacks:
+            if name not in values:
+                continue
+            out += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            out += [f"{name}{self._labels(tuple(sorted(lb.items())))} {v}" for lb, v in values[name]]
+        return "\n".join(out) + "\n"
+
+    @staticmethod
+    def _collect(callbacks: list) -> Dict[str, list]:
+        values = {}
+        for name, _, _, fn, _ in callbacks:
+            try:
+                values[name] = list(fn())
+            except Exception as e:
+                log.debug("metric %s failed: %s", name, e)
+        return values
+
+    def _collect_on_loop(self, callbacks: list) -> Dict[str, list]:
+        loop = self._loop
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        if loop is None or loop.is_closed() or loop is current:
+            return self._collect(callbacks)   # لا حلقة بعد (أو انتهت)، أو نحن عليها أصلاً
+        async def snapshot():
+            return self._collect(callbacks)
+        try:
+            return asyncio.run_coroutine_threadsafe(snapshot(), loop).result(timeout=5)
+        except Exception as e:
+            log.warning("metrics snapshot on loop failed: %s", e)
+            return {}
+
+METRICS = Metrics()
+METRICS.histogram("convbot_stage_seconds", "Job stage duration: download, queue_wait, convert, upload")
+METRICS.histogram("convbot_compression_ratio", "Output size / input size per operation", RATIO_BUCKETS)
+METRICS.counter("convbot_input_bytes_total", "Input bytes processed")
+METRICS.counter("convbot_output_bytes_total", "Output bytes produced")
+METRICS.counter("convbot_jobs_total", "Finished operations by result")
+METRICS.counter("convbot_subprocess_exits_total", "External command exits by binary and status")
 
 # اشتراك القناة
 CHANNEL_CHAT_ID: Optional[int] = None
@@ -118,16 +481,31 @@ T = {
         "file_too_big": "❌ الملف أكبر من الحد المسموح ({mb}MB).",
         "file_too_big_dl": "❌ تيليجرام يمنع تنزيل الملفات الأكبر من {mb}MB عبر البوت. أرسل ملفًا أصغر أو رابط تحميل مباشر (HTTP/HTTPS).",
         "choose_section": "اختر القسم:",
+        "url_downloading": "⬇️ جارٍ تنزيل الرابط…",
+        "album_received": "📚 استلمت {n} ملفات كمجموعة واحدة. اختر القسم:",
         "sec_convert": "🔁 تحويل الملفات",
         "sec_compress": "🗜️ ضغط الملفات",
         "choose_action": "ماذا تريد أن أفعل بهذا الملف؟",
         "choose_ratio": "اختر نسبة الضغط:",
+        "fit_btn": "🎯 أقل من {mb}MB",
         "working": "⏳ يتم التنفيذ، انتظر من فضلك…",
+        "busy": "⏳ جارٍ التنفيذ…",
+        "progress_pct": "{bar} {pct}%",
+        "progress_pages": "📄 الصفحة {done}/{total}",
+        "cancel_btn": "✖️ إلغاء",
+        "cancelled": "🛑 تم الإلغاء.",
         "failed": "❌ حدث خطأ: {err}",
         "sent": "✅ تم الإرسال.",
         "admin_only": "هذا الأمر للمدير فقط.",
         "formats_title": "الصيغ المتاحة للتحويل:",
-        "stats": "📊 إحصائيات سريعة:\nمستخدمون فريدون تقريباً: {u}\nعمليات: {c}",
+        "stats": ("📊 إحصائيات سريعة:\nمستخدمون فريدون تقريباً: {u}\nعمليات: {c}\n"
+                  "قيد التنفيذ: {r} | في الطابور: {q}\nCPU: {cpu}/{cpu_max} | الانتظار: متوسط {wa:.1f}ث، أقصى {wm:.1f}ث"),
+        "stats_gc": "🧹 الكنس: {mb:.1f}MB مستردة | منتهية: {exp} | يتيمة: {orph} | مُخلاة: {ev}",
+        "stats_cache": "♻️ الكاش: إصابة {hits} | إخفاق {misses} | النسبة {rate:.0%} | العناصر {size} | مشتركة {shared}",
+        "stats_media": "🎞️ ffmpeg: نسخ كامل {copy} | نسخ الفيديو {copy_video} | نسخ الصوت {copy_audio} | إعادة ترميز {transcode}",
+        "stats_pdf": "📄 ضغط PDF (فوز/تشغيل، زمن، حجم): {items}",
+        "stats_out": "📤 الإرسال: مُرسلة {sent} | إعادة {retries} | انتظار 429 {flood_waits} | مُسقطة {dropped} | في الطابور {queued}",
+        "stats_members": "👥 كاش العضوية: إصابة {hits} | إخفاق {misses} | مدموجة {coalesced} | قديمة عند الخطأ {stale} | إبطال {invalidated} | العناصر {size}",
         "lang_saved": "✅ تم ضبط اللغة على العربية.",
         "lang_prompt": "↪️ اختر لغتك من الأزرار.",
         "no_gs": "⚠️ ضغط PDF يتطلب Ghostscript. تم استخدام ضغط بديل وقد لا يكون الأفضل.",
@@ -147,29 +525,82 @@ T = {
         "file_too_big": "❌ File exceeds allowed limit ({mb}MB).",
         "file_too_big_dl": "❌ Telegram prevents bots from downloading files larger than {mb}MB. Please send a smaller file or a direct HTTP/HTTPS link.",
         "choose_section": "Pick a section:",
+        "url_downloading": "⬇️ Downloading link…",
+        "album_received": "📚 Got {n} files as one batch. Pick a section:",
         "sec_convert": "🔁 Convert",
         "sec_compress": "🗜️ Compress",
         "choose_action": "What do you want to do with this file?",
         "choose_ratio": "Pick compression ratio:",
+        "fit_btn": "🎯 Fit under {mb}MB",
         "working": "⏳ Working, please wait…",
+        "busy": "⏳ Already working on it…",
+        "progress_pct": "{bar} {pct}%",
+        "progress_pages": "📄 Page {done}/{total}",
+        "cancel_btn": "✖️ Cancel",
+        "cancelled": "🛑 Cancelled.",
         "failed": "❌ Error: {err}",
         "sent": "✅ Sent.",
         "admin_only": "This command is admin-only.",
         "formats_title": "Supported conversions:",
-        "stats": "📊 Quick stats:\nApprox unique users: {u}\nOps: {c}",
+        "stats": ("📊 Quick stats:\nApprox unique users: {u}\nOps: {c}\n"
+                  "Running: {r} | Queued: {q}\nCPU: {cpu}/{cpu_max} | Wait: avg {wa:.1f}s, max {wm:.1f}s"),
+        "stats_gc": "🧹 GC: {mb:.1f}MB reclaimed | expired: {exp} | orphans: {orph} | evicted: {ev}",
+        "stats_cache": "♻️ Cache: hits {hits} | misses {misses} | rate {rate:.0%} | items {size} | shared {shared}",
+        "stats_media": "🎞️ ffmpeg: full copy {copy} | video copy {copy_video} | audio copy {copy_audio} | transcode {transcode}",
+        "stats_pdf": "📄 PDF compress (wins/runs, time, size): {items}",
+        "stats_out": "📤 Outbound: sent {sent} | retries {retries} | 429 waits {flood_waits} | dropped {dropped} | queued {queued}",
+        "stats_members": "👥 Membership cache: hits {hits} | misses {misses} | coalesced {coalesced} | stale on error {stale} | invalidated {invalidated} | items {size}",
         "lang_saved": "✅ Language set to English.",
         "lang_prompt": "↪️ Pick your language via buttons.",
         "no_gs": "⚠️ PDF compression needs Ghostscript. Used fallback compression which may be weaker.",
     },
 }
 
+class LangCache:
+    """لغة كل مستخدم محلياً بمدة صلاحية: tr() متزامنة وتُستدعى في كل رد فلا تنتظر المخزن المشترك.
+    تُملأ قبل المعالجات من خيط (prime)، وتُحدَّث فوراً عند اختيار اللغة."""
+
+    def __init__(self, ttl: int, max_items: int):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._mem: "OrderedDict[int, Tuple[str, float]]" = OrderedDict()
+
+    def set(self, user_id: int, lang: Optional[str]) -> None:
+        self._mem[user_id] = (lang or "", time.monotonic())
+        self._mem.move_to_end(user_id)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def _fresh(self, user_id: int) -> Optional[str]:
+        ent = self._mem.get(user_id)
+        if ent and time.monotonic() - ent[1] <= self.ttl:
+            return ent[0]
+        return None
+
+    def get(self, user_id: int) -> str:
+        lang = self._fresh(user_id)
+        if lang is None:   # لم يمر بـ prime (تسليم بعد إعادة التشغيل مثلاً): قراءة مباشرة مرة واحدة
+            lang = STATE.get(f"lang:{user_id}") or ""
+            self.set(user_id, lang)
+        return lang or "ar"
+
+    async def prime(self, user_id: int) -> None:
+        if self._fresh(user_id) is None:
+            self.set(user_id, await asyncio.to_thread(STATE.get, f"lang:{user_id}"))
+
+LANGS = LangCache(LANG_TTL, MEMBER_CACHE_SIZE)
+
 def lang_of(update: Update) -> str:
     uid = update.effective_user.id if update.effective_user else 0
-    return USER_LANG.get(uid, "ar")
+    return LANGS.get(uid)
 
 def tr(update: Update, key: str, **kw) -> str:
     return T.get(lang_of(update), T["ar"]).get(key, key).format(**kw)
 
+def tr_user(user_id: int, key: str, **kw) -> str:
+    # بلا Update (تسليم نتيجة بعد إعادة التشغيل)
+    return T.get(LANGS.get(user_id), T["ar"]).get(key, key).format(**kw)
+
 def reply_kb():
     return ReplyKeyboardMarkup(
         [[KeyboardButton("/start"), KeyboardButton("/help")]], resize_keyboard=True
@@ -179,6 +610,78 @@ def clean_name(name: str) -> str:
     safe = SAFE_CHARS.sub("_", name)
     return safe[:128] or "file"
 
+# ======== كاش عضوية القناة ========
+
+JOINED_STATUSES = ("member", "administrator", "creator")
+
+class MembershipCache:
+    """حالة اشتراك كل مستخدم بمدة صلاحية؛ الطلبات المتزامنة لنفس المستخدم تشترك في استعلام واحد."""
+
+    def __init__(self, ttl: int, neg_ttl: int, max_items: int):
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self.max_items = max_items
+        self._mem: "OrderedDict[int, Tuple[bool, float]]" = OrderedDict()
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self.hits = self.misses = self.coalesced = self.stale = self.invalidated = 0
+
+    def set(self, user_id: int, joined: bool) -> None:
+        self._mem[user_id] = (joined, time.monotonic())
+        self._mem.move_to_end(user_id)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[int] = None) -> None:
+        if user_id is None:
+            self.invalidated += len(self._mem)
+            self._mem.clear()
+        elif self._mem.pop(user_id, None) is not None:
+            self.invalidated += 1
+
+    async def is_joined(self, bot, chat_id: int, user_id: int) -> bool:
+        ent = self._mem.get(user_id)
+        if ent and time.monotonic() - ent[1] <= (self.ttl if ent[0] else self.neg_ttl):
+            self._mem.move_to_end(user_id)
+            self.hits += 1
+            return ent[0]
+        fut = self._inflight.get(user_id)
+        if fut is not None:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+        self.misses += 1
+        fut = asyncio.ensure_future(self._lookup(bot, chat_id, user_id, ent))
+        self._inflight[user_id] = fut
+        fut.add_done_callback(lambda _f: self._inflight.pop(user_id, None))
+        return await asyncio.shield(fut)
+
+    async def _lookup(self, bot, chat_id: int, user_id: int, ent) -> bool:
+        try:
+            member = await bot.get_chat_member(chat_id, user_id)
+        except Exception as e:
+            log.warning("ensure_joined error: %s", e)
+            # تيليجرام غير متاح أو قيّدنا: حالة إيجابية سابقة أولى من منع مشترك
+            if ent and ent[0]:
+                self.stale += 1
+                return True
+            return False
+        joined = member.status in JOINED_STATUSES
+        self.set(user_id, joined)
+        return joined
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                "stale": self.stale, "invalidated": self.invalidated, "size": len(self._mem)}
+
+MEMBERS = MembershipCache(MEMBER_TTL, MEMBER_NEG_TTL, MEMBER_CACHE_SIZE)
+
+async def on_chat_member(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # يصل فقط إن كان البوت مشرفاً في القناة؛ نحدّث الحالة مباشرة بدل انتظار انتهاء المدة
+    cm = update.chat_member
+    if not cm or not CHANNEL_CHAT_ID or cm.chat.id != CHANNEL_CHAT_ID:
+        return
+    MEMBERS.invalidate(cm.new_chat_member.user.id)
+    MEMBERS.set(cm.new_chat_member.user.id, cm.new_chat_member.status in JOINED_STATUSES)
+
 async def ensure_joined(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> bool:
     global CHANNEL_CHAT_ID, CHANNEL_USERNAME_LINK
     if not CHANNEL_CHAT_ID:
@@ -186,12 +689,8 @@ async def ensure_joined(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> bool:
     user = update.effective_user
     if not user:
         return True
-    try:
-        member = await ctx.bot.get_chat_member(CHANNEL_CHAT_ID, user.id)
-        if member.status in ("member", "administrator", "creator"):
-            return True
-    except Exception as e:
-        log.warning("ensure_joined error: %s", e)
+    if await MEMBERS.is_joined(ctx.bot, CHANNEL_CHAT_ID, user.id):
+        return True
 
     btn = InlineKeyboardMarkup.from_button(
         InlineKeyboardButton(tr(update, "join_btn"), url=f"https://t.me/{CHANNEL_USERNAME_LINK}")
@@ -199,6 +698,63 @@ async def ensure_joined(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> bool:
     await update.effective_message.reply_text(tr(update, "must_join"), reply_markup=btn)
     return False
 
+# ========= معالجة التحديثات بالتوازي =========
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """توازي بين المستخدمين مع الحفاظ على ترتيب تحديثات المستخدم الواحد."""
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiting: Dict[int, int] = {}
+
+    async def process_update(self, update, coroutine) -> None:
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user:
+                key = update.effective_user.id
+            elif update.effective_chat:
+                key = update.effective_chat.id
+        # زر الإلغاء يجب ألا ينتظر خلف المهمة التي يريد إلغاءها
+        if key is None or (update.callback_query and (update.callback_query.data or "").startswith("cancel:")):
+            await super().process_update(update, coroutine)
+            return
+        # قفل المستخدم قبل حجز مقعد عام، حتى لا يستهلك طابور مستخدم واحد كل المقاعد
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                self._waiting.pop(key, None)
+                self._locks.pop(key, None)
+
+    async def do_process_update(self, update, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# العمل الطويل (تحويل، تنزيل رابط) يخرج من المعالج إلى مهمة خلفية بعد التحقق؛
+# قفل المستخدم أعلاه يضمن ترتيب الاستقبال فقط، لا أن تنتظر ضغطاته التالية ساعة.
+BACKGROUND: set = set()
+
+def _background_done(task: asyncio.Task) -> None:
+    BACKGROUND.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("background task failed", exc_info=task.exception())
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    BACKGROUND.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
 # ========= Handlers =========
 
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -220,11 +776,16 @@ async def cmd_lang(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     ])
     await update.effective_message.reply_text(tr(update, "lang_prompt"), reply_markup=kb)
 
+async def prime_lang(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        await LANGS.prime(update.effective_user.id)
+
 async def cb_lang(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     choice = q.data.split(":")[1]
-    USER_LANG[q.from_user.id] = choice
+    await asyncio.to_thread(STATE.set, f"lang:{q.from_user.id}", choice)
+    LANGS.set(q.from_user.id, choice)
     await q.edit_message_text(T[choice]["lang_saved"], reply_markup=None)
     await q.message.reply_text(
         f"<b>{T[choice]['start_title']}</b>\n\n{T[choice]['start_desc']}",
@@ -255,14 +816,25 @@ async def cmd_formats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     lines.append("• Compression: Images/PDF/Audio/Video/Other (10%→90%)")
     await update.effective_message.reply_text(f"{tr(update, 'formats_title')}\n\n" + "\n".join(lines))
 
-STATS_U = set()
-STATS_C = 0
-
 async def cmd_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not update.effective_user or update.effective_user.id != OWNER_ID:
         await update.effective_message.reply_text(tr(update, "admin_only"))
         return
-    await update.effective_message.reply_text(tr(update, "stats", u=len(STATS_U), c=STATS_C))
+    st = SCHEDULER.stats()
+    users, ops = await asyncio.gather(asyncio.to_thread(STATE.scard, "stats:users"),
+                                      asyncio.to_thread(STATE.get, "stats:ops"))
+    await update.effective_message.reply_text(tr(
+        update, "stats", u=users, c=int(ops or 0),
+        r=st["running"], q=st["queued"], cpu=st["cpu_used"], cpu_max=st["cpu_units"],
+        wa=st["wait_avg"], wm=st["wait_max"],
+    ) + "\n" + tr(
+        update, "stats_gc", mb=GC_STATS["reclaimed_bytes"] / 1024 / 1024,
+        exp=GC_STATS["expired"], orph=GC_STATS["orphans"], ev=GC_STATS["evicted"],
+    ) + "\n" + tr(update, "stats_cache", shared=FLIGHTS.shared, **RESULT_CACHE.stats())
+    + "\n" + tr(update, "stats_media", **MEDIA_PATHS)
+    + "\n" + tr(update, "stats_pdf", items=_pdf_strategy_summary())
+    + "\n" + tr(update, "stats_members", **MEMBERS.stats())
+    + "\n" + tr(update, "stats_out", **OUTBOX.stats()))
 
 async def cmd_debugsub(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not update.effective_user or update.effective_user.id != OWNER_ID:
@@ -310,10 +882,292 @@ def conv_options(kind: str) -> list:
 class Job:
     user_id: int
     kind: str
-    file_path: Path
+    file_id: str
     file_name: str
+    file_size: int = 0
+    file_unique_id: str = ""                   # مفتاح الكاش؛ وإلا نستخدم بصمة المحتوى
+    url: str = ""                              # رابط مباشر بدل ملف تيليجرام
+    content_hash: str = ""
+    file_path: Optional[Path] = None           # يُملأ عند بدء التنزيل
+    fetch: Optional[asyncio.Future] = None
+    created: float = field(default_factory=time.time)
+    busy: bool = False                         # قيد التنفيذ: لا يلمسه الكنّاس
+    parts: Optional[list] = None               # مهمة مجمّعة (ألبوم): المهام الفرعية
+
+# حقول تخص العملية الحالية فقط (ملف مُنزَّل محلياً، تنزيل جارٍ)؛ لا تُحفظ في المخزن المشترك
+_JOB_LOCAL_FIELDS = ("file_path", "fetch", "busy")
+
+def _job_to_dict(job: Job) -> dict:
+    d = {f.name: getattr(job, f.name) for f in fields(Job) if f.name not in _JOB_LOCAL_FIELDS}
+    d["parts"] = [_job_to_dict(p) for p in job.parts] if job.parts else None
+    return d
+
+def _job_from_dict(d: dict) -> Job:
+    parts = d.pop("parts", None)
+    job = Job(**d)
+    if parts:
+        job.parts = [_job_from_dict(p) for p in parts]
+    return job
+
+class JobStore:
+    """المهام المعلّقة: الكائنات الحيّة محلياً، وبياناتها في STATE حتى يكمل أي نسخة الضغطة التالية.
+    النسخة التي تستلم الزر تنزّل الملف بنفسها عبر file_id/url عند الحاجة."""
+
+    def __init__(self, state, ttl: int):
+        self.state = state
+        self.ttl = ttl
+        self._local: Dict[str, Job] = {}
+
+    # المخزن قد يكون Redis (رحلة شبكة) أو SQLite (قفل كتابة حتى 10ث): لا يُلمس من حلقة الأحداث
+
+    def _write(self, token: str, job: Job) -> None:
+        try:
+            self.state.set(f"job:{token}", json.dumps(_job_to_dict(job)), ex=self.ttl)
+        except Exception as e:
+            log.warning("job store write failed: %s", e)
+
+    def _read(self, token: str) -> Optional[str]:
+        try:
+            return self.state.get(f"job:{token}")
+        except Exception as e:
+            log.warning("job store read failed: %s", e)
+            return None
+
+    def _delete(self, token: str) -> None:
+        try:
+            self.state.delete(f"job:{token}")
+        except Exception as e:
+            log.warning("job store delete failed: %s", e)
+
+    async def put(self, token: str, job: Job) -> None:
+        self._local[token] = job
+        await self.save(token, job)
+
+    async def save(self, token: str, job: Job) -> None:
+        await asyncio.to_thread(self._write, token, job)
+
+    def peek(self, token: str) -> Optional[Job]:
+        return self._local.get(token)
+
+    async def get(self, token: str, default=None) -> Optional[Job]:
+        job = self._local.get(token)
+        if job is not None:
+            return job
+        raw = await asyncio.to_thread(self._read, token)
+        if not raw:
+            return default
+        # ضغطتان متزامنتان على نسخة لم ترَ المهمة: كائن واحد حتى يصح حجز busy
+        return self._local.setdefault(token, _job_from_dict(json.loads(raw)))
+
+    def pop(self, token: str, default=None) -> Optional[Job]:
+        job = self._local.pop(token, default)
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._delete, token)
+        except RuntimeError:
+            self._delete(token)
+        return job
+
+    # الكنّاس يعمل على ما تملكه هذه العملية محلياً فقط
+    def items(self):
+        return self._local.items()
 
-JOBS: Dict[str, Job] = {}
+    def values(self):
+        return self._local.values()
+
+    def __len__(self) -> int:
+        return len(self._local)
+
+JOBS = JobStore(STATE, JOB_TTL)
+
+# ======== التنزيل الكسول ========
+# لا ننزّل الملف عند وصوله؛ ننتظر حتى يُظهر المستخدم نيته (اختيار القسم) أو ينفّذ فعلاً.
+
+async def _download_job(job: Job, bot) -> Path:
+    t0 = time.monotonic()
+    tmpd = Path(tempfile.mkdtemp(prefix=f"u{job.user_id}_", dir=WORK_ROOT))
+    path = tmpd / job.file_name
+    job.file_path = path
+    try:
+        if job.parts:
+            # ألبوم: كل العناصر تُنزَّل بالتوازي إلى مجلد المهمة نفسه
+            for part in job.parts:
+                part.file_path = tmpd / part.file_name
+            await asyncio.gather(*(_fetch_part(part, bot) for part in job.parts))
+            path.mkdir()
+        elif job.url:
+            name, ctype = await fetch_url(job.url, path, URL_MAX)
+            # الاسم والنوع الحقيقيان يُعرفان من الاستجابة فقط
+            job.file_name = clean_name(name)
+            job.kind = detect_kind(job.file_name, ctype)
+            final = tmpd / job.file_name
+            if final != path:
+                path = path.rename(final)
+                job.file_path = path
+        else:
+            fobj = await bot.get_file(job.file_id)
+            await fobj.download_to_drive(path.as_posix())
+    except BaseException:
+        job.file_path = None
+        shutil.rmtree(tmpd, ignore_errors=True)
+        raise
+    METRICS.observe("convbot_stage_seconds", time.monotonic() - t0, stage="download", kind=job.kind, code="")
+    log.info("[download] fetched %s (%.2fMB)", job.file_name, path.stat().st_size / 1024 / 1024)
+    return path
+
+async def _fetch_part(part: Job, bot) -> None:
+    fobj = await bot.get_file(part.file_id)
+    await fobj.download_to_drive(part.file_path.as_posix())
+
+def prefetch_job(job: Job, bot) -> asyncio.Future:
+    if job.fetch is None:
+        job.fetch = asyncio.ensure_future(_download_job(job, bot))
+        # نستهلك الاستثناء هنا حتى لا يُسجَّل كخطأ غير مُلتقط إن لم ينتظره أحد
+        job.fetch.add_done_callback(lambda f: f.cancelled() or f.exception())
+    return job.fetch
+
+async def ensure_downloaded(job: Job, bot) -> Path:
+    fut = prefetch_job(job, bot)
+    try:
+        return await asyncio.shield(fut)
+    except Exception:
+        if job.fetch is fut:
+            job.fetch = None   # نسمح بإعادة المحاولة عند الضغط التالي
+        raise
+
+def cleanup_job(token: str) -> int:
+    """يحذف المهمة ومجلدها، ويعيد عدد البايتات المستردة."""
+    job = JOBS.pop(token, None)
+    if not job:
+        return 0
+    if job.fetch is not None and not job.fetch.done():
+        job.fetch.cancel()
+    freed = 0
+    try:
+        if job.file_path and job.file_path.parent.exists():
+            freed = _dir_size(job.file_path.parent)
+            shutil.rmtree(job.file_path.parent, ignore_errors=True)
+    except Exception:
+        pass
+    return freed
+
+# ======== كنس المهام المهجورة والمجلدات اليتيمة ========
+
+GC_STATS = {"reclaimed_bytes": 0, "expired": 0, "orphans": 0, "evicted": 0, "runs": 0}
+BOOT_TIME = time.time()
+
+def _dir_size(p: Path) -> int:
+    if p.is_file():
+        return p.stat().st_size
+    total = 0
+    for root, _, files in os.walk(p):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+def _free_bytes() -> int:
+    try:
+        return shutil.disk_usage(WORK_ROOT).free
+    except OSError:
+        return 1 << 62
+
+def _replica_alive(p: Path) -> bool:
+    # مجلد نسخة أخرى: حيّة ما دام قفلها محجوزاً
+    try:
+        with open(p / ".lock", "r") as f:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        return True
+    return False
+
+def _sweep_entries(paths, live: set, now: float) -> Tuple[int, int]:
+    count = freed = 0
+    for p in paths:
+        if p in live or p.name == ".lock":
+            continue
+        try:
+            mtime = p.stat().st_mtime
+        except OSError:
+            continue
+        if mtime >= BOOT_TIME and now - mtime < GC_ORPHAN_AGE:
+            continue
+        size = _dir_size(p)
+        if p.is_dir():
+            shutil.rmtree(p, ignore_errors=True)
+        else:
+            p.unlink(missing_ok=True)
+        count += 1
+        freed += size
+    return count, freed
+
+_REPLICA_DIR = re.compile(r"r\d+")
+
+def _sweep_orphans(live: set) -> Tuple[int, int]:
+    # أي شيء تحت WORK_ROOT لا تملكه مهمة حيّة: بقايا انهيار/إعادة تشغيل أو مهام ضائعة
+    now = time.time()
+    count, freed = _sweep_entries(WORK_ROOT.iterdir(), live, now)
+    loose = []   # بقايا التخطيط القديم مباشرة تحت WORK_BASE
+    for root in WORK_BASE.iterdir():
+        if root == WORK_ROOT:
+            continue
+        if not (root.is_dir() and _REPLICA_DIR.fullmatch(root.name)):
+            loose.append(root)
+            continue
+        if _replica_alive(root):
+            continue
+        # نسخة ميتة: مهام الطابور الدائم في مجلدها ما زالت تنتظر عاملاً أو تسليماً،
+        # فنكنس ما بداخله مهمةً مهمة ولا نحذف المجلد نفسه إلا حين يفرغ
+        c, f = _sweep_entries(root.iterdir(), live, now)
+        count, freed = count + c, freed + f
+        if all(p.name == ".lock" for p in root.iterdir()):
+            (root / ".lock").unlink(missing_ok=True)
+            try:
+                root.rmdir()
+            except OSError:
+                pass
+    c, f = _sweep_entries(loose, live, now)
+    return count + c, freed + f
+
+async def gc_sweep() -> None:
+    now = time.time()
+    for token, job in list(JOBS.items()):
+        if not job.busy and now - job.created > JOB_TTL:
+            GC_STATS["reclaimed_bytes"] += cleanup_job(token)
+            GC_STATS["expired"] += 1
+
+    live = {j.file_path.parent for j in JOBS.values() if j.file_path}
+    if WORKQ is not None:
+        live |= await asyncio.to_thread(WORKQ.live_dirs)
+    count, freed = await asyncio.to_thread(_sweep_orphans, live)
+    GC_STATS["orphans"] += count
+    GC_STATS["reclaimed_bytes"] += freed
+
+    watermark = GC_MIN_FREE_MB * 1024 * 1024
+    if _free_bytes() < watermark:
+        idle = sorted(((j.created, t) for t, j in JOBS.items() if not j.busy), key=lambda x: x[0])
+        for _, token in idle:
+            if _free_bytes() >= watermark:
+                break
+            GC_STATS["reclaimed_bytes"] += cleanup_job(token)
+            GC_STATS["evicted"] += 1
+    purge = getattr(STATE, "purge_expired", None)   # Redis يحذف المنتهي بنفسه
+    if purge is not None:
+        await asyncio.to_thread(purge)
+    GC_STATS["runs"] += 1
+
+async def gc_loop() -> None:
+    while True:
+        try:
+            await gc_sweep()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("gc sweep failed")
+        await asyncio.sleep(GC_INTERVAL)
 
 # ======== استقبال الملف وإظهار اختيار القسم ========
 
@@ -321,7 +1175,7 @@ async def on_file(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not await ensure_joined(update, ctx):
         return
     if update.effective_user:
-        STATS_U.add(update.effective_user.id)
+        await asyncio.to_thread(STATE.sadd, "stats:users", update.effective_user.id)
 
     msg = update.effective_message
 
@@ -365,65 +1219,913 @@ async def on_file(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await msg.reply_text(tr(update, "file_too_big", mb=TG_LIMIT_MB))
         return
 
-    tmpd = Path(tempfile.mkdtemp(prefix=f"u{update.effective_user.id}_", dir=WORK_ROOT))
-    in_path = tmpd / (SAFE_CHARS.sub("_", fname)[:128] or "file")
-    fobj = await ctx.bot.get_file(file_id)
-    await fobj.download_to_drive(in_path.as_posix())
+    job = Job(update.effective_user.id, kind, file_id, clean_name(fname), size,
+              file_unique_id=tgfile.file_unique_id or "")
+    if msg.media_group_id:
+        _collect_album(update, ctx, msg.media_group_id, job)
+        return
 
     token = os.urandom(6).hex()
-    JOBS[token] = Job(update.effective_user.id, kind, in_path, in_path.name)
+    await JOBS.put(token, job)
+    if PREFETCH_DELAY > 0:
+        bot = ctx.bot
+        asyncio.get_running_loop().call_later(
+            PREFETCH_DELAY, lambda: JOBS.peek(token) is job and prefetch_job(job, bot)
+        )
 
-    kb = InlineKeyboardMarkup([
+    await msg.reply_text(tr(update, "choose_section"), reply_markup=_section_keyboard(token, update))
+
+# ======== الألبومات (media groups) ========
+# كل صورة في الألبوم تصل كرسالة مستقلة؛ نجمعها حسب media_group_id ثم نعرض خياراً واحداً للمجموعة.
+
+ALBUMS: Dict[Tuple[int, str], dict] = {}
+
+def _collect_album(update: Update, ctx: ContextTypes.DEFAULT_TYPE, group_id: str, job: Job) -> None:
+    key = (job.user_id, group_id)
+    album = ALBUMS.setdefault(key, {"update": update, "parts": [], "timer": None})
+    album["parts"].append(job)
+    if album["timer"] is not None:
+        album["timer"].cancel()
+    bot = ctx.bot
+    album["timer"] = asyncio.get_running_loop().call_later(
+        ALBUM_WINDOW, lambda: asyncio.ensure_future(_flush_album(key, bot))
+    )
+
+async def _flush_album(key: Tuple[int, str], bot) -> None:
+    album = ALBUMS.pop(key, None)
+    if not album:
+        return
+    update, parts = album["update"], album["parts"]
+    token = os.urandom(6).hex()
+    if len(parts) == 1:
+        await JOBS.put(token, parts[0])
+        text = tr(update, "choose_section")
+    else:
+        for i, p in enumerate(parts, 1):
+            p.file_name = f"{i:03d}_{p.file_name}"   # أسماء الصور في الألبوم متطابقة غالباً
+        kinds = {p.kind for p in parts}
+        await JOBS.put(token, Job(key[0], kinds.pop() if len(kinds) == 1 else "other", "",
+                                  f"batch_{len(parts)}", sum(p.file_size for p in parts), parts=parts))
+        text = tr(update, "album_received", n=len(parts))
+    try:
+        await update.effective_message.reply_text(text, reply_markup=_section_keyboard(token, update))
+    except Exception:
+        log.exception("album reply failed")
+
+def batch_conv_options(job: Job) -> list:
+    # خيارات مشتركة بين كل العناصر فقط؛ الصور تحصل على PDF واحد متعدد الصفحات
+    opts = [o for o in conv_options(job.kind) if o[1] != "img2pdf"]
+    if job.kind == "image":
+        opts.insert(0, ("IMGS→PDF (1)", "imgs2pdf"))
+    return opts
+
+def _section_keyboard(token: str, update: Update) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
         [InlineKeyboardButton(tr(update, "sec_convert"), callback_data=f"mode:{token}:conv")],
         [InlineKeyboardButton(tr(update, "sec_compress"), callback_data=f"mode:{token}:zip")],
     ])
-    await msg.reply_text(tr(update, "choose_section"), reply_markup=kb)
+
+# ======== استقبال الروابط المباشرة ========
+
+URL_RE = re.compile(r"https?://\S+", re.IGNORECASE)
+
+class DownloadTooBig(RuntimeError):
+    pass
+
+HTTP: Optional[httpx.AsyncClient] = None
+
+def http_client() -> httpx.AsyncClient:
+    """عميل HTTP مشترك على مستوى التطبيق (اتصالات keep-alive محدودة)."""
+    global HTTP
+    if HTTP is None or HTTP.is_closed:
+        HTTP = httpx.AsyncClient(
+            timeout=httpx.Timeout(60, connect=15),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            headers={"User-Agent": "convbot/1.0"},
+        )
+    return HTTP
+
+class _PublicOnlyBackend(httpcore.AsyncNetworkBackend):
+    """يحل الاسم ويرفض العناوين الداخلية ثم يتصل بالعنوان نفسه الذي فُحص، فلا يستطيع DNS rebinding
+    تغيير الجواب بين الفحص والاتصال. SNI وترويسة Host يبقيان على الاسم الأصلي."""
+
+    def __init__(self):
+        self._inner = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        infos = await asyncio.to_thread(socket.getaddrinfo, host, port, type=socket.SOCK_STREAM)
+        ips = list(dict.fromkeys(info[4][0] for info in infos))
+        if not URL_ALLOW_PRIVATE and any(not ipaddress.ip_address(ip).is_global for ip in ips):
+            raise RuntimeError("رابط غير مسموح")
+        last: Optional[Exception] = None
+        for ip in ips:
+            try:
+                return await self._inner.connect_tcp(ip, port, timeout=timeout, local_address=local_address,
+                                                     socket_options=socket_options)
+            except httpcore.ConnectError as e:
+                last = e
+        raise last or httpcore.ConnectError(f"no address for {host}")
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise RuntimeError("رابط غير مسموح")
+
+    async def sleep(self, seconds: float) -> None:
+        await self._inner.sleep(seconds)
+
+# أخطاء httpcore → أخطاء httpx (الأخص أولاً) كي تلتقطها http_retry وfetch_url كما مع النقل الافتراضي
+_HTTPCORE_ERRORS = (
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout),
+    (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout),
+    (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.TimeoutException, httpx.TimeoutException),
+    (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError),
+    (httpcore.WriteError, httpx.WriteError),
+    (httpcore.NetworkError, httpx.NetworkError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError),
+    (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.ProtocolError, httpx.ProtocolError),
+)
+
+def _httpx_error(e: Exception) -> Exception:
+    for src, dst in _HTTPCORE_ERRORS:
+        if isinstance(e, src):
+            err = dst(str(e))
+            err.__cause__ = e
+            return err
+    return e
+
+class _PublicOnlyStream(httpx.AsyncByteStream):
+    def __init__(self, stream):
+        self._stream = stream
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except Exception as e:
+            raise _httpx_error(e)
+
+    async def aclose(self) -> None:
+        await self._stream.aclose()
+
+class _PublicOnlyTransport(httpx.AsyncBaseTransport):
+    """نقل httpx فوق مجمّع httpcore يُنشأ بـ _PublicOnlyBackend صراحةً، فلا اتصال إلا عبر الفحص."""
+
+    def __init__(self, max_connections: int, max_keepalive: int):
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            network_backend=_PublicOnlyBackend(),
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        req = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=request.url.raw_scheme, host=request.url.raw_host,
+                             port=request.url.port, target=request.url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        try:
+            resp = await self._pool.handle_async_request(req)
+        except Exception as e:
+            raise _httpx_error(e)
+        return httpx.Response(status_code=resp.status, headers=resp.headers,
+                              stream=_PublicOnlyStream(resp.stream), extensions=resp.extensions)
+
+    async def aclose(self) -> None:
+        await self._pool.aclose()
+
+URL_HTTP: Optional[httpx.AsyncClient] = None
+
+def url_client() -> httpx.AsyncClient:
+    """عميل روابط المستخدمين: كل اتصال يمر بفحص _PublicOnlyBackend، وبلا وكيل من البيئة
+    (الفحص يجب أن يقع على عنوان الخادم الهدف لا الوكيل)."""
+    global URL_HTTP
+    if URL_HTTP is None or URL_HTTP.is_closed:
+        URL_HTTP = httpx.AsyncClient(
+            transport=_PublicOnlyTransport(max_connections=20, max_keepalive=10),
+            trust_env=False,
+            timeout=httpx.Timeout(60, connect=15),
+            headers={"User-Agent": "convbot/1.0"},
+        )
+    return URL_HTTP
+
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+async def http_retry(fn, what: str):
+    """ينفّذ fn() مع إعادة محاولة محدودة وتراجع أُسّي عند أخطاء الشبكة و429/5xx."""
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            return await fn()
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            resp = getattr(e, "response", None) if isinstance(e, httpx.HTTPStatusError) else None
+            if (resp is not None and resp.status_code not in _RETRY_STATUS) or attempt == HTTP_RETRIES:
+                raise
+            delay = min(30, 2 ** attempt)
+            if resp is not None and (resp.headers.get("retry-after") or "").isdigit():
+                delay = min(60, int(resp.headers["retry-after"]))
+            log.warning("[http] %s failed (%s), retry %d in %ss", what, e, attempt + 1, delay)
+            await asyncio.sleep(delay)
+
+async def http_download(url: str, dest: Path, timeout: float = 120) -> None:
+    """ينزّل الاستجابة إلى القرص على دفعات دون إبقائها في الذاكرة."""
+    async with http_client().stream("GET", url, timeout=timeout) as r:
+        r.raise_for_status()
+        with dest.open("wb") as f:
+            async for chunk in r.aiter_bytes(1 << 16):
+                f.write(chunk)
+
+def _check_public_url(url: str) -> None:
+    # العناوين الداخلية (localhost، metadata، الشبكة الخاصة) يرفضها _PublicOnlyBackend عند الاتصال
+    u = urlparse(url)
+    if u.scheme not in ("http", "https") or not u.hostname:
+        raise RuntimeError("رابط غير صالح")
+
+def _filename_from(resp: httpx.Response, url: str) -> str:
+    cd = resp.headers.get("content-disposition", "")
+    m = re.search(r"filename\*=(?:UTF-8'')?([^;]+)", cd, re.IGNORECASE) or re.search(r'filename="?([^";]+)"?', cd, re.IGNORECASE)
+    if m:
+        return unquote(m.group(1).strip())
+    return unquote(Path(urlparse(url).path).name) or "file"
+
+async def fetch_url(url: str, dest: Path, limit: int) -> Tuple[str, Optional[str]]:
+    """ينزّل الرابط على دفعات مباشرة إلى القرص، ويستأنف بـ Range عند انقطاع الاتصال."""
+    client = url_client()
+    got = 0
+    attempts = 0
+    name, ctype = "file", None
+    with dest.open("wb") as f:
+        while True:
+            headers = {"Range": f"bytes={got}-"} if got else {}
+            try:
+                for _ in range(5):
+                    _check_public_url(url)
+                    req = client.build_request("GET", url, headers=headers)
+                    resp = await client.send(req, stream=True)
+                    if not resp.is_redirect:
+                        break
+                    await resp.aclose()
+                    url = urljoin(url, resp.headers.get("location", ""))
+                else:
+                    raise RuntimeError("تحويلات كثيرة")
+                try:
+                    if got and resp.status_code != 206:
+                        # الخادم تجاهل Range: نبدأ من الصفر
+                        f.seek(0)
+                        f.truncate()
+                        got = 0
+                    resp.raise_for_status()
+                    if not got:
+                        name, ctype = _filename_from(resp, url), resp.headers.get("content-type")
+                    clen = int(resp.headers.get("content-length") or 0)
+                    if clen and got + clen > limit:
+                        raise DownloadTooBig()
+                    async for chunk in resp.aiter_bytes(1 << 16):
+                        got += len(chunk)
+                        if got > limit:
+                            raise DownloadTooBig()
+                        f.write(chunk)
+                finally:
+                    await resp.aclose()
+                log.info("[url] fetched %s (%.2fMB)", url, got / 1024 / 1024)
+                return name, ctype
+            except httpx.TransportError as e:
+                attempts += 1
+                if attempts > URL_RETRIES:
+                    raise RuntimeError(f"فشل تنزيل الرابط: {e}")
+                log.warning("[url] transfer interrupted at %d bytes, resuming (%s)", got, e)
+                await asyncio.sleep(min(8, 2 ** attempts))
+
+async def on_url(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not await ensure_joined(update, ctx):
+        return
+    msg = update.effective_message
+    m = URL_RE.search(msg.text or "")
+    if not m or not update.effective_user:
+        return
+    await asyncio.to_thread(STATE.sadd, "stats:users", update.effective_user.id)
+
+    url = m.group(0)
+    token = os.urandom(6).hex()
+    job = Job(update.effective_user.id, "other", "", "download", url=url)
+    await JOBS.put(token, job)
+    status = await msg.reply_text(tr(update, "url_downloading"))
+    spawn(_ingest_url(update, ctx, token, job, status))
+
+async def _ingest_url(update: Update, ctx: ContextTypes.DEFAULT_TYPE, token: str, job: Job, status) -> None:
+    try:
+        await ensure_downloaded(job, ctx.bot)
+    except DownloadTooBig:
+        cleanup_job(token)
+        await status.edit_text(tr(update, "file_too_big", mb=URL_MAX_MB))
+        return
+    except Exception as e:
+        log.warning("url ingest failed: %s", e)
+        cleanup_job(token)
+        await status.edit_text(tr(update, "failed", err=str(e)[:200]))
+        return
+    await JOBS.save(token, job)   # الاسم والنوع الحقيقيان عُرفا من الاستجابة
+    await status.edit_text(tr(update, "choose_section"), reply_markup=_section_keyboard(token, update))
+
+# ======== تقدم المهام الطويلة وزر الإلغاء ========
+
+class Progress:
+    """رسالة الحالة لمهمة جارية: تحديثات مقيّدة بـ PROGRESS_INTERVAL وزر إلغاء."""
+
+    def __init__(self, update: Update, token: str):
+        self.update = update
+        self.token = token
+        self.message = update.callback_query.message
+        self.task = asyncio.current_task()
+        self.cancelled = False
+        self.closed = False
+        self._last = 0.0
+        self._text = ""
+        self._edit: Optional[asyncio.Task] = None
+
+    def markup(self) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([[InlineKeyboardButton(tr(self.update, "cancel_btn"),
+                                                           callback_data=f"cancel:{self.token}")]])
+
+    def report(self, done: float, total: float, pages: bool = False) -> None:
+        # بعد الإلغاء أو الإغلاق قد يستمر تنفيذ مشترك بسياق هذه الرسالة: لا نعيد شريط التقدم فوق "تم الإلغاء"
+        if total <= 0 or self.closed:
+            return
+        now = time.monotonic()
+        # لا نكدّس التعديلات: تعديل واحد جارٍ على الأكثر وفاصل أدنى بينها
+        if now - self._last < PROGRESS_INTERVAL or (self._edit and not self._edit.done()):
+            return
+        if pages:
+            line = tr(self.update, "progress_pages", done=int(done), total=int(total))
+        else:
+            pct = max(0, min(100, int(done * 100 / total)))
+            line = tr(self.update, "progress_pct", bar="▰" * (pct // 10) + "▱" * (10 - pct // 10), pct=pct)
+        text = f"{tr(self.update, 'working')}\n{line}"
+        if text == self._text:
+            return
+        self._last, self._text = now, text
+        self._edit = asyncio.ensure_future(self._send(text))
+
+    async def _send(self, text: str) -> None:
+        async def edit():
+            if self.closed:   # أُغلقت أثناء انتظار دورها في الطابور
+                return None
+            return await self.message.edit_text(text, reply_markup=self.markup())
+
+        try:
+            await OUTBOX.send(self.message.chat_id, edit, priority=PRI_STATUS, droppable=True)
+        except Exception as e:
+            log.debug("progress edit failed: %s", e)
+
+    def close(self) -> None:
+        self.closed = True
+        RUNNING.pop(self.token, None)
+        if self._edit and not self._edit.done():
+            self._edit.cancel()
+
+    async def finish(self, text: Optional[str] = None) -> None:
+        """يغلق رسالة الحالة: نص نهائي، أو إزالة زر الإلغاء فقط."""
+        self.close()
+        try:
+            if text:
+                await OUTBOX.send(self.message.chat_id, lambda: self.message.edit_text(text), priority=PRI_STATUS)
+            else:
+                await OUTBOX.send(self.message.chat_id, lambda: self.message.edit_reply_markup(reply_markup=None),
+                                  priority=PRI_STATUS)
+        except Exception as e:
+            log.debug("progress finish failed: %s", e)
+
+    def cancel(self) -> None:
+        # إلغاء مهمة المعالج: run_cmd يقتل العملية، ومجمّع CPU يستبدل العامل، والمجدول يحرر المقعد
+        self.cancelled = True
+        self.close()
+        if self.task is not None:
+            self.task.cancel()
+
+# المهمة الجارية في السياق الحالي؛ run_cmd وpdf_to_docx يبلّغان عنها دون تمريرها عبر كل دالة
+PROGRESS: ContextVar[Optional[Progress]] = ContextVar("progress", default=None)
+RUNNING: Dict[str, Progress] = {}   # token -> Progress، لزر الإلغاء
+
+def report_progress(done: float, total: float, pages: bool = False) -> None:
+    prog = PROGRESS.get()
+    if prog is not None:
+        prog.report(done, total, pages)
+
+_FF_DURATION = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+_GS_PAGES = re.compile(r"Processing pages \d+ through (\d+)")
+_GS_PAGE = re.compile(r"^Page (\d+)$")
+
+def _ffmpeg_progress(duration: float):
+    state = {"duration": duration}
+    def on_line(line: str) -> None:
+        if line.startswith("out_time_us=") or line.startswith("out_time_ms="):
+            # كلاهما بالميكروثانية في ffmpeg
+            value = line.split("=", 1)[1]
+            if value.isdigit() and state["duration"] > 0:
+                report_progress(int(value) / 1e6, state["duration"])
+        elif not state["duration"]:
+            # بلا مدة من ffprobe: نأخذها من ترويسة ffmpeg نفسها
+            m = _FF_DURATION.search(line)
+            if m:
+                h, mi, se = m.groups()
+                state["duration"] = int(h) * 3600 + int(mi) * 60 + float(se)
+    return on_line
+
+def _gs_progress():
+    state = {"total": 0}
+    def on_line(line: str) -> None:
+        m = _GS_PAGES.search(line)
+        if m:
+            state["total"] = int(m.group(1))
+            return
+        m = _GS_PAGE.match(line)
+        if m and state["total"]:
+            report_progress(int(m.group(1)), state["total"], pages=True)
+    return on_line
+
+async def _read_stream(stream: asyncio.StreamReader, on_line=None) -> bytes:
+    # قراءة بالقطع لا بالأسطر: readline يفشل على الأسطر الأطول من حد المخزن
+    buf, tail = bytearray(), b""
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        buf += chunk
+        if on_line is not None:
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            for ln in lines:
+                on_line(ln.decode("utf-8", "ignore").strip())
+    return bytes(buf)
 
 # ======== تشغيل أوامر النظام ========
 
-async def run_cmd(cmd: list, cwd=None, timeout=600) -> Tuple[int, str, str]:
+async def run_cmd(cmd: list, cwd=None, timeout=600, duration: float = 0.0) -> Tuple[int, str, str]:
+    """duration (من ffprobe) تُستخدم لنسبة تقدم ffmpeg عند وجود رسالة تقدم في السياق."""
+    on_line = None
+    if PROGRESS.get() is not None:
+        if cmd[0] == BIN["ffmpeg"]:
+            cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+            on_line = _ffmpeg_progress(duration)
+        elif cmd[0] == BIN["gs"]:
+            # -dQUIET يخفي عدّاد "Page N"
+            cmd = [c for c in cmd if c != "-dQUIET"]
+            on_line = _gs_progress()
     proc = await asyncio.create_subprocess_exec(
         *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=cwd
     )
-    out_b, err_b = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+
+    async def communicate() -> Tuple[bytes, bytes]:
+        out_b, err_b = await asyncio.gather(_read_stream(proc.stdout, on_line),
+                                            _read_stream(proc.stderr, on_line))
+        await proc.wait()
+        return out_b, err_b
+
+    binary = Path(cmd[0]).name
+    try:
+        out_b, err_b = await asyncio.wait_for(communicate(), timeout=timeout)
+    except BaseException:
+        # مهلة أو إلغاء: لا نترك العملية تعمل يتيمة في الخلفية
+        METRICS.inc("convbot_subprocess_exits_total", binary=binary, status="killed")
+        if proc.returncode is None:
+            proc.kill()
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=5)
+            except BaseException:
+                pass
+        raise
+    METRICS.inc("convbot_subprocess_exits_total", binary=binary, status=str(proc.returncode))
     return proc.returncode, out_b.decode("utf-8", "ignore"), err_b.decode("utf-8", "ignore")
 
+# ======== فحص الوسائط (ffprobe) ========
+
+# أي مسار نفّذه ffmpeg: نسخ بلا ترميز أم إعادة ترميز، لقياس التوفير
+MEDIA_PATHS: Dict[str, int] = {"copy": 0, "copy_video": 0, "copy_audio": 0, "transcode": 0}
+
+async def probe_media(path: Path) -> dict:
+    """ملخص ffprobe: الترميزات والمدة ومعدلات البت. يعيد {} إن تعذر الفحص."""
+    if not BIN["ffprobe"]:
+        return {}
+    cmd = [BIN["ffprobe"], "-v", "error", "-print_format", "json",
+           "-show_streams", "-show_format", path.as_posix()]
+    try:
+        code, out, _ = await run_cmd(cmd, timeout=60)
+        data = json.loads(out or "{}") if code == 0 else {}
+    except Exception as e:
+        log.warning("ffprobe failed: %s", e)
+        return {}
+    info = {"vcodec": None, "acodec": None, "abitrate": 0, "vbitrate": 0, "duration": 0.0, "bitrate": 0}
+    for st in data.get("streams", []):
+        if st.get("codec_type") == "video" and info["vcodec"] is None:
+            if (st.get("disposition") or {}).get("attached_pic"):
+                continue   # غلاف ألبوم داخل ملف صوتي
+            info["vcodec"] = st.get("codec_name")
+            info["vbitrate"] = int(st.get("bit_rate") or 0)
+        elif st.get("codec_type") == "audio" and info["acodec"] is None:
+            info["acodec"] = st.get("codec_name")
+            info["abitrate"] = int(st.get("bit_rate") or 0)
+    fmt = data.get("format") or {}
+    info["duration"] = float(fmt.get("duration") or 0)
+    info["bitrate"] = int(fmt.get("bit_rate") or 0)
+    if not info["abitrate"] and info["vcodec"] is None:
+        info["abitrate"] = info["bitrate"]
+    return info
+
+def _video_plan(info: dict) -> str:
+    if info.get("vcodec") == "h264":
+        return "copy" if info.get("acodec") in (None, "aac") else "copy_video"
+    return "transcode"
+
+# ======== مجمّع عمليات المعالج ========
+# أعمال Pillow/PyMuPDF/pdf2docx متزامنة وتحجز حلقة الأحداث، لذلك تُنفَّذ في عمليات منفصلة.
+# كل عامل يملك أنبوبه الخاص، فعند انتهاء المهلة نقتل هذا العامل وحده ونستبدله دون كسر البقية.
+
+class _CpuWorker:
+    """عملية تشغّل cpu_tasks.py مباشرة (لا spawn من multiprocessing الذي يعيد تنفيذ bot.py كاملاً
+    في كل عامل)، وتتبادل معها (fn, args) على زوج مقابس."""
+
+    def __init__(self):
+        parent, child = socket.socketpair()
+        self.proc = subprocess.Popen(
+            [sys.executable, cpu_tasks.__file__, str(child.fileno())],
+            pass_fds=(child.fileno(),), stdin=subprocess.DEVNULL,
+        )
+        child.close()
+        self.conn = Connection(parent.detach())
+
+    def kill(self) -> None:
+        try:
+            self.proc.kill()
+            self.proc.wait(timeout=5)
+        except Exception:
+            pass
+        self.conn.close()
+
+# حصة المهمة الجارية من المجمّع (سيمافور، عدد العمّال): يضبطها SCHEDULER.slot بقدر وحدات CPU الممنوحة،
+# فلا تحجز مهمة واحدة كل العمّال بمهامها الفرعية وتؤخر خلفها الطلبات الخفيفة
+CPU_SHARE: ContextVar[Optional[Tuple[asyncio.Semaphore, int]]] = ContextVar("cpu_share", default=None)
+
+class CpuPool:
+    def __init__(self, workers: int, mode: str = "process"):
+        self.workers = max(1, workers)
+        self.mode = mode
+        self._idle: Optional[asyncio.Queue] = None
+        self._all: list = []
+        self._threads: Optional[ThreadPoolExecutor] = None
+
+    def _ensure(self) -> None:
+        if self.mode == "thread":
+            if self._threads is None:
+                self._threads = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="cpu")
+            return
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.workers):
+                self._idle.put_nowait(self._spawn())
+            log.info("[cpu] started %d worker processes", self.workers)
+
+    def _spawn(self) -> _CpuWorker:
+        w = _CpuWorker()
+        self._all.append(w)
+        return w
+
+    def _retire(self, w: _CpuWorker) -> None:
+        w.kill()
+        if w in self._all:
+            self._all.remove(w)
+
+    async def _recv(self, w: _CpuWorker):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = w.conn.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            loop.remove_reader(fd)
+        return w.conn.recv()
+
+    def width(self) -> int:
+        """عدد المهام الفرعية التي تعمل معاً لهذه المهمة؛ للتقسيم إلى أجزاء."""
+        share = CPU_SHARE.get()
+        return min(self.workers, share[1]) if share else self.workers
+
+    async def run(self, fn, *args, timeout: Optional[float] = None):
+        """ينفّذ fn(*args) خارج حلقة الأحداث. fn يجب أن تكون دالة على مستوى الوحدة."""
+        share = CPU_SHARE.get()
+        if share is None:
+            return await self._run(fn, args, timeout)
+        # الجزء التالي لا يدخل طابور العمّال إلا حين ينتهي أحد أجزاء المهمة نفسها
+        async with share[0]:
+            return await self._run(fn, args, timeout)
+
+    async def _run(self, fn, args: tuple, timeout: Optional[float]):
+        self._ensure()
+        if self.mode == "thread":
+            # الخيوط لا يمكن إيقافها قسراً؛ المهلة تحرر المستدعي فقط
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(
+                loop.run_in_executor(self._threads, functools.partial(fn, *args)), timeout
+            )
+        w = await self._idle.get()
+        try:
+            w.conn.send((fn, args))
+            status, val = await asyncio.wait_for(self._recv(w), timeout)
+        except BaseException:
+            # مهلة/إلغاء/موت العامل: نقتله ونستبدله حتى لا يبقى يعمل في الخلفية
+            self._retire(w)
+            w = self._spawn()
+            raise
+        finally:
+            self._idle.put_nowait(w)
+        if status == "err":
+            raise val
+        return val
+
+    def shutdown(self) -> None:
+        for w in list(self._all):
+            w.kill()
+        self._all.clear()
+        if self._threads is not None:
+            self._threads.shutdown(wait=False, cancel_futures=True)
+
+CPU_POOL = CpuPool(CPU_WORKERS, CPU_POOL_MODE)
+
 # ======== تحويل ========
 
 async def image_to_pdf(in_path: Path, out_path: Path):
-    with Image.open(in_path) as im:
-        if im.mode in ("RGBA", "P"):
-            im = im.convert("RGB")
-        im.save(out_path, "PDF")
+    await CPU_POOL.run(_image_to_pdf, in_path, out_path, timeout=300)
 
 async def image_convert(in_path: Path, out_path: Path):
-    with Image.open(in_path) as im:
-        if out_path.suffix.lower() in (".jpg", ".jpeg") and im.mode in ("RGBA", "P"):
-            im = im.convert("RGB")
-        im.save(out_path)
+    await CPU_POOL.run(_image_convert, in_path, out_path, timeout=300)
 
-async def pdf_to_images_zip(in_path: Path, fmt: str, out_zip: Path):
-    images = convert_from_path(in_path.as_posix(), fmt=fmt)
+async def pdf_to_images_zip(in_path: Path, fmt: str, out_zip: Path, dpi: int = PDF_IMG_DPI):
+    pages = await CPU_POOL.run(_pdf_page_count, in_path, timeout=60)
+    if pages <= 0:
+        raise RuntimeError("PDF بلا صفحات")
     d = out_zip.parent / (out_zip.stem + "_pages")
     d.mkdir(parents=True, exist_ok=True)
-    files = []
-    for i, im in enumerate(images, 1):
-        p = d / f"page_{i:03d}.{fmt}"
-        im.save(p)
-        files.append(p)
-    import zipfile
-    with zipfile.ZipFile(out_zip, "w") as z:
-        for p in files:
-            z.write(p, arcname=p.name)
+    parts = max(1, min(CPU_POOL.width(), -(-pages // max(1, PDF_IMG_CHUNK))))
+    step = -(-pages // parts)
+    tasks = [
+        asyncio.ensure_future(CPU_POOL.run(_render_pdf_range, in_path, fmt, dpi, a, min(pages, a + step), d, timeout=900))
+        for a in range(0, pages, step)
+    ]
+    try:
+        # الصور مضغوطة أصلاً فنخزنها بلا ضغط، وكل صفحة تُحذف فور إضافتها
+        with zipfile.ZipFile(out_zip, "w", compression=zipfile.ZIP_STORED) as z:
+            for t in tasks:
+                for p in await t:
+                    z.write(p, arcname=p.name)
+                    p.unlink(missing_ok=True)
+    finally:
+        for t in tasks:
+            t.cancel()
+        shutil.rmtree(d, ignore_errors=True)
+
+async def pdf_to_docx(in_path: Path, out_path: Path,
+                      progress: Optional[Callable[[int, int], None]] = None) -> Tuple[int, int]:
+    """يعيد (عدد الصفحات المحوّلة، عدد صفحات الملف)؛ الأول أقل عند السقف أو انتهاء المهلة."""
+    total = await CPU_POOL.run(_pdf_page_count, in_path, timeout=60)
+    pages = min(total, PDF2DOCX_MAX_PAGES) if PDF2DOCX_MAX_PAGES else total
+    if pages <= 0:
+        raise RuntimeError("PDF بلا صفحات")
+    jdir = out_path.parent / (out_path.stem + "_parts")
+    jdir.mkdir(parents=True, exist_ok=True)
+    step = max(1, PDF2DOCX_CHUNK)
+    ranges = [(a, min(pages, a + step)) for a in range(0, pages, step)]
+    jsons = [jdir / f"{i:04d}.json" for i in range(len(ranges))]
+    tasks = [
+        asyncio.ensure_future(CPU_POOL.run(_pdf2docx_parse_range, in_path, a, b, j, timeout=PDF2DOCX_TIMEOUT))
+        for (a, b), j in zip(ranges, jsons)
+    ]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + PDF2DOCX_TIMEOUT
+    parsed = 0
+    try:
+        pending = set(tasks)
+        while pending:
+            left = deadline - loop.time()
+            if left <= 0:
+                log.warning("[pdf2docx] timeout after %d/%d pages", parsed, pages)
+                break
+            done, pending = await asyncio.wait(pending, timeout=left, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if not t.exception():
+                    a, b = ranges[tasks.index(t)]
+                    parsed += b - a
+            if progress and done:
+                progress(parsed, pages)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # نستخدم البادئة المتصلة فقط حتى لا تظهر فجوات في المستند الجزئي
+    ok = []
+    for t, j in zip(tasks, jsons):
+        if t.cancelled() or t.exception() is not None:
+            break
+        ok.append(j)
+    if not ok:
+        err = next((t.exception() for t in tasks if not t.cancelled() and t.exception()), None)
+        raise RuntimeError(f"PDF→DOCX failed: {err or 'timeout'}")
+    try:
+        await CPU_POOL.run(_pdf2docx_make, in_path, ok, out_path, timeout=600)
+    finally:
+        shutil.rmtree(jdir, ignore_errors=True)
+    done_pages = ranges[len(ok) - 1][1]
+    log.info("[pdf2docx] %d/%d pages (file has %d)", done_pages, pages, total)
+    return done_pages, total
+
+# ======== مجمّع LibreOffice الدافئ ========
+# تشغيل soffice يكلّف ثوانٍ لكل مستند، والتشغيلات المتزامنة على نفس الملف الشخصي تتعارض.
+# لذلك نُبقي عدة نسخ تعمل، لكل منها ملف شخصي ومنفذ خاص، ويُرسل لها المستند عبر جسر UNO
+# (يعمل ببايثون النظام لأن uno لا يُثبَّت عبر pip).
+
+_UNO_BRIDGE = r"""
+import json, sys, time, uno
+from com.sun.star.beans import PropertyValue
+
+def prop(name, value):
+    p = PropertyValue(); p.Name = name; p.Value = value
+    return p
+
+port = int(sys.argv[1])
+local = uno.getComponentContext()
+resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+for _ in range(150):
+    try:
+        ctx = resolver.resolve("uno:socket,host=127.0.0.1,port=%d;urp;StarOffice.ComponentContext" % port)
+        break
+    except Exception:
+        time.sleep(0.2)
+else:
+    sys.exit(2)
+desktop = ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+print(json.dumps({"ready": True}), flush=True)
+for line in sys.stdin:
+    req = json.loads(line)
+    try:
+        doc = desktop.loadComponentFromURL(uno.systemPathToFileUrl(req["in"]), "_blank", 0, (prop("Hidden", True),))
+        if doc is None:
+            raise RuntimeError("cannot load document")
+        try:
+            doc.storeToURL(uno.systemPathToFileUrl(req["out"]), (prop("FilterName", req["filter"]),))
+        finally:
+            doc.close(True)
+        print(json.dumps({"ok": True}), flush=True)
+    except Exception as e:
+        print(json.dumps({"ok": False, "error": str(e)}), flush=True)
+"""
+
+_OFFICE_FILTERS = {
+    "xls": "calc_pdf_Export", "xlsx": "calc_pdf_Export", "ods": "calc_pdf_Export",
+    "ppt": "impress_pdf_Export", "pptx": "impress_pdf_Export", "odp": "impress_pdf_Export",
+}
+
+def _office_filter(path: Path) -> str:
+    return _OFFICE_FILTERS.get(path.suffix.lower().lstrip("."), "writer_pdf_Export")
+
+def _kill_group(proc) -> None:
+    if proc is None or proc.returncode is not None:
+        return
+    try:
+        os.killpg(proc.pid, 9)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+class _OfficeWorker:
+    def __init__(self, idx: int):
+        self.idx = idx
+        self.port = OFFICE_BASE_PORT + WORKER_INDEX * OFFICE_WORKERS + idx
+        self.profile = OFFICE_ROOT / f"profile_{idx}"
+        self.soffice = None
+        self.bridge = None
+        self.jobs = 0
+
+    async def start(self) -> None:
+        self.profile.mkdir(parents=True, exist_ok=True)
+        self.soffice = await asyncio.create_subprocess_exec(
+            BIN["soffice"], "--headless", "--invisible", "--nologo", "--norestore", "--nodefault",
+            f"-env:UserInstallation={self.profile.as_uri()}",
+            f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        self.bridge = await asyncio.create_subprocess_exec(
+            OFFICE_PYTHON, "-c", _UNO_BRIDGE, str(self.port),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL, start_new_session=True,
+        )
+        line = await asyncio.wait_for(self.bridge.stdout.readline(), timeout=60)
+        if not line or not json.loads(line).get("ready"):
+            await self.stop()
+            raise RuntimeError("LibreOffice worker failed to start")
+        self.jobs = 0
+        log.info("[office] worker %d ready on port %d", self.idx, self.port)
+
+    async def stop(self) -> None:
+        for p in (self.bridge, self.soffice):
+            _kill_group(p)
+            if p is not None:
+                try:
+                    await asyncio.wait_for(p.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+        self.bridge = self.soffice = None
+
+    async def convert(self, in_path: Path, out_path: Path) -> None:
+        req = {"in": in_path.resolve().as_posix(), "out": out_path.resolve().as_posix(),
+               "filter": _office_filter(in_path)}
+        self.bridge.stdin.write((json.dumps(req) + "\n").encode())
+        await self.bridge.stdin.drain()
+        line = await asyncio.wait_for(self.bridge.stdout.readline(), timeout=OFFICE_TIMEOUT)
+        if not line:
+            raise RuntimeError("LibreOffice worker died")
+        self.jobs += 1
+        res = json.loads(line)
+        if not res.get("ok"):
+            raise RuntimeError(f"LibreOffice failed: {res.get('error')}")
+
+class OfficePool:
+    def __init__(self, size: int):
+        self.size = size
+        self.available: Optional[bool] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._lock = asyncio.Lock()
+        self.restarts = 0
+
+    async def _ensure(self) -> bool:
+        async with self._lock:
+            if self.available is None:
+                self.available = await self._probe()
+                if self.available:
+                    self._idle = asyncio.Queue()
+                    for i in range(self.size):
+                        self._idle.put_nowait(_OfficeWorker(i))
+                else:
+                    log.info("[office] warm pool unavailable, using one soffice per document")
+        return self.available
+
+    async def _probe(self) -> bool:
+        if self.size <= 0 or not BIN["soffice"] or not shutil.which(OFFICE_PYTHON):
+            return False
+        try:
+            code, _, _ = await run_cmd([OFFICE_PYTHON, "-c", "import uno"], timeout=20)
+        except Exception:
+            return False
+        return code == 0
+
+    async def convert(self, in_path: Path, out_path: Path) -> bool:
+        """يعيد False إن لم يكن المجمّع متاحاً، ليستخدم المستدعي المسار البارد."""
+        if not await self._ensure():
+            return False
+        w = await self._idle.get()
+        try:
+            if w.bridge is None:
+                await w.start()
+            await w.convert(in_path, out_path)
+        except BaseException:
+            # عامل معلّق أو ميت: نقتله ويُعاد تشغيله عند الطلب التالي
+            await w.stop()
+            self.restarts += 1
+            raise
+        finally:
+            if w.bridge is not None and w.jobs >= OFFICE_MAX_JOBS:
+                await w.stop()
+                self.restarts += 1
+            self._idle.put_nowait(w)
+        return True
+
+    async def shutdown(self) -> None:
+        if self._idle is None:
+            return
+        while not self._idle.empty():
+            await self._idle.get_nowait().stop()
 
-async def pdf_to_docx(in_path: Path, out_path: Path):
-    pdf2docx_parse(in_path.as_posix(), out_path.as_posix())
+OFFICE_POOL = OfficePool(OFFICE_WORKERS)
 
 async def office_to_pdf(in_path: Path, out_path: Path):
+    if BIN["soffice"] and await OFFICE_POOL.convert(in_path, out_path):
+        if not out_path.exists():
+            raise RuntimeError("output not found")
+        return
+
     if BIN["soffice"]:
-        cmd = [BIN["soffice"], "--headless", "--convert-to", "pdf",
+        # المسار البارد: ملف شخصي منفصل لكل تشغيل حتى لا تتسلسل التشغيلات المتزامنة أو تفشل
+        profile = out_path.parent / ".lo_profile"
+        cmd = [BIN["soffice"], "--headless", f"-env:UserInstallation={profile.resolve().as_uri()}",
+               "--convert-to", "pdf",
                "--outdir", out_path.parent.as_posix(), in_path.as_posix()]
         code, out, err = await run_cmd(cmd)
+        shutil.rmtree(profile, ignore_errors=True)
         if code != 0:
             raise RuntimeError(f"LibreOffice failed: {err or out}")
         cand = out_path.parent / (in_path.stem + ".pdf")
@@ -436,20 +2138,24 @@ async def office_to_pdf(in_path: Path, out_path: Path):
     if PDFCO_API_KEY:
         ext = in_path.suffix.lower().lstrip(".")
         url = f"https://api.pdf.co/v1/pdf/convert/from/{ext}"
-        headers = {"x-api-key": PDFCO_API_KEY}
-        files = {"file": (in_path.name, in_path.read_bytes())}
-        async with httpx.AsyncClient(timeout=120) as client:
-            r = await client.post(url, headers=headers, files=files)
+
+        async def upload() -> dict:
+            # ملف مفتوح بدل bytes: httpx يبث الـ multipart من القرص على دفعات
+            with in_path.open("rb") as f:
+                r = await http_client().post(
+                    url, headers={"x-api-key": PDFCO_API_KEY},
+                    files={"file": (in_path.name, f)}, timeout=120,
+                )
             r.raise_for_status()
-            jr = r.json()
-            if not jr.get("success"):
-                raise RuntimeError(jr.get("message", "pdfco failed"))
-            link = jr.get("url")
-            if not link:
-                raise RuntimeError("pdfco: no url in response")
-            pdf = await client.get(link)
-            pdf.raise_for_status()
-            out_path.write_bytes(pdf.content)
+            return r.json()
+
+        jr = await http_retry(upload, "pdfco upload")
+        if not jr.get("success"):
+            raise RuntimeError(jr.get("message", "pdfco failed"))
+        link = jr.get("url")
+        if not link:
+            raise RuntimeError("pdfco: no url in response")
+        await http_retry(lambda: http_download(link, out_path), "pdfco download")
         return
 
     raise RuntimeError("Office→PDF غير متاح: لا يوجد LibreOffice ولا PDF.co API")
@@ -465,15 +2171,6 @@ def _map_audio_bitrate(pct: int) -> int:
 def _map_video_crf(pct: int) -> int:
     return int(min(38, max(18, 18 + pct//3)))
 
-def _map_jpeg_quality(pct: int) -> int:
-    return int(max(25, 100 - pct))
-
-def _map_webp_quality(pct: int) -> int:
-    return int(max(25, 100 - pct))
-
-def _map_png_compresslevel(pct: int) -> int:
-    return int(min(9, round((pct/100)*9)))
-
 def _map_pdf_res(pct: int) -> int:
     return int(max(72, 300 - (pct * (300-72))//100))
 
@@ -483,22 +2180,7 @@ def _map_pdf_jpegq(pct: int) -> int:
 # ======== ضغط ========
 
 async def compress_image(in_path: Path, pct: int, out_path: Path):
-    with Image.open(in_path) as im:
-        ext = in_path.suffix.lower()
-        if ext in (".jpg", ".jpeg"):
-            q = _map_jpeg_quality(pct)
-            if im.mode in ("RGBA", "P"):
-                im = im.convert("RGB")
-            im.save(out_path.with_suffix(".jpg"), quality=q, optimize=True, progressive=True)
-            return out_path.with_suffix(".jpg")
-        elif ext in (".webp",):
-            q = _map_webp_quality(pct)
-            im.save(out_path.with_suffix(".webp"), quality=q, method=6)
-            return out_path.with_suffix(".webp")
-        else:
-            cl = _map_png_compresslevel(pct)
-            im.save(out_path.with_suffix(".png"), optimize=True, compress_level=cl)
-            return out_path.with_suffix(".png")
+    return await CPU_POOL.run(_compress_image, in_path, pct, out_path, timeout=300)
 
 async def _gs_try(in_path: Path, out_path: Path, pct: int) -> bool:
     dpi = _map_pdf_res(pct)
@@ -554,78 +2236,596 @@ async def _gs_screen(in_path: Path, out_path: Path) -> bool:
         log.warning("gs /screen failed: %s", err or out)
     return ok
 
+# ======== محرك ضغط صور PDF داخل العملية (PyMuPDF) ========
+# يعيد ترميز صور الصفحات JPEG بدقة عرض مستهدفة، بديلاً أسرع من تشغيل gs (أو حين لا يتوفر).
+
+async def pdf_recompress_images(in_path: Path, out_path: Path, pct: int) -> bool:
+    plan = await CPU_POOL.run(_pdf_image_plan, in_path, timeout=120)
+    if not plan:
+        return False
+    # الصور الأكبر أولاً ثم توزيع دوري حتى تتقارب أحمال العمال
+    plan.sort(key=lambda it: it["w"] * it["h"], reverse=True)
+    n = max(1, min(CPU_POOL.width(), len(plan)))
+    chunks = [plan[i::n] for i in range(n)]
+    dpi, q = _map_pdf_res(pct), _map_pdf_jpegq(pct)
+    parts = await asyncio.gather(*(
+        CPU_POOL.run(_recompress_images, in_path, c, dpi, q, timeout=900) for c in chunks
+    ))
+    repl: Dict[int, bytes] = {}
+    for p in parts:
+        repl.update(p)
+    if not repl:
+        return False
+    await CPU_POOL.run(_apply_image_replacements, in_path, out_path, repl, timeout=900)
+    return True
+
+async def _fitz_strategy(in_path: Path, out_path: Path) -> bool:
+    await CPU_POOL.run(_fitz_deflate, in_path, out_path, timeout=900)
+    return True
+
+# إحصاءات كل استراتيجية: تشغيل/فوز/إلغاء/تخطٍّ، الزمن الكلي، ومجموع نسب الحجم الناتج
+PDF_STRATEGY_STATS: Dict[str, dict] = {}
+
+def _pdf_stat(name: str) -> dict:
+    return PDF_STRATEGY_STATS.setdefault(
+        name, {"runs": 0, "wins": 0, "failed": 0, "cancelled": 0, "skipped": 0, "time": 0.0, "ratio": 0.0}
+    )
+
+def _pdf_strategy_summary() -> str:
+    items = []
+    for name, st in PDF_STRATEGY_STATS.items():
+        done = st["runs"] - st["failed"] - st["cancelled"]
+        avg_t = st["time"] / done if done else 0.0
+        avg_r = st["ratio"] / done if done else 0.0
+        items.append(f"{name} {st['wins']}/{st['runs']} {avg_t:.1f}s {avg_r:.0%}")
+    return ", ".join(items) or "-"
+
 async def compress_pdf(in_path: Path, pct: int, out_path: Path):
     in_size = in_path.stat().st_size
-
+    target = int(in_size * max(0.1, 1 - pct / 100.0))
+    try:
+        scan = await CPU_POOL.run(_pdf_scan, in_path, timeout=60)
+    except Exception as e:
+        log.warning("pdf scan failed: %s", e)
+        scan = {"images": -1}
+
+    # المرشحون بالترتيب المفضّل؛ /screen مفيد فقط لملفات فيها صور وبنسب عالية
+    strategies = {}
+    # محرك PyMuPDF أولاً: أسرع من gs، وإن حقق الهدف لا يبدأ gs أصلاً عند PDF_PARALLEL=1
+    if scan["images"] != 0:
+        strategies["fitz_img"] = lambda o: pdf_recompress_images(in_path, o, pct)
+    else:
+        _pdf_stat("fitz_img")["skipped"] += 1
     if BIN["gs"]:
-        ok = await _gs_try(in_path, out_path, pct)
-        if ok and out_path.stat().st_size < in_size * 0.98:
-            return out_path
-
-        tmp2 = out_path.with_suffix(".screen.pdf")
-        ok2 = await _gs_screen(in_path, tmp2)
-        if ok2 and tmp2.stat().st_size < min(in_size, out_path.stat().st_size if out_path.exists() else in_size) * 0.98:
-            if out_path.exists():
-                out_path.unlink(missing_ok=True)
-            tmp2.rename(out_path)
-            return out_path
-        else:
-            keep = out_path.with_name(out_path.stem.replace("_compressed", "") + "_compressed_keep.pdf")
-            shutil.copy2(in_path, keep)
-            if out_path.exists(): out_path.unlink(missing_ok=True)
-            return keep
-
+        strategies["gs"] = lambda o: _gs_try(in_path, o, pct)
+        if scan["images"] != 0 and pct >= 50:
+            strategies["gs_screen"] = lambda o: _gs_screen(in_path, o)
+        elif scan["images"] == 0:
+            _pdf_stat("gs_screen")["skipped"] += 1
+    strategies["fitz"] = lambda o: _fitz_strategy(in_path, o)
+
+    sem = asyncio.Semaphore(PDF_PARALLEL)
+
+    async def run(name: str, fn):
+        out = out_path.with_suffix(f".{name}.pdf")
+        st = _pdf_stat(name)
+        async with sem:
+            st["runs"] += 1
+            t0 = time.monotonic()
+            try:
+                ok = await fn(out)
+            except asyncio.CancelledError:
+                st["cancelled"] += 1
+                raise
+            except Exception as e:
+                log.warning("pdf strategy %s failed: %s", name, e)
+                ok = False
+            size = out.stat().st_size if ok and out.exists() else 0
+            if not size:
+                st["failed"] += 1
+                return name, out, None
+            dt = time.monotonic() - t0
+            st["time"] += dt
+            st["ratio"] += size / max(1, in_size)
+            log.info("[pdf] %s: %.1fs %.2fMB → %.2fMB", name, dt, in_size / 1024 / 1024, size / 1024 / 1024)
+            return name, out, size
+
+    tasks = [asyncio.ensure_future(run(n, f)) for n, f in strategies.items()]
+    results = []
     try:
-        doc = fitz.open(in_path.as_posix())
-        doc.save(out_path.as_posix(), deflate=True, garbage=3)
-        doc.close()
-        if out_path.stat().st_size < in_size * 0.98:
-            return out_path
-        keep = out_path.with_name(out_path.stem.replace("_compressed", "") + "_compressed_keep.pdf")
-        shutil.copy2(in_path, keep)
-        out_path.unlink(missing_ok=True)
-        return keep
-    except Exception:
+        for fut in asyncio.as_completed(tasks):
+            res = await fut
+            results.append(res)
+            if res[2] is not None and res[2] <= target:
+                break   # أول من يحقق الهدف يفوز؛ البقية تُلغى (ويُقتل gs)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    good = [r for r in results if r[2] is not None and r[2] < in_size * 0.98]
+    best = min(good, key=lambda r: r[2]) if good else None
+    if good and good[-1][2] <= target:
+        best = good[-1]
+    for name, out, _ in results:
+        if best is None or out != best[1]:
+            out.unlink(missing_ok=True)
+    if best:
+        _pdf_stat(best[0])["wins"] += 1
+        return best[1].rename(out_path)
+
+    if not any(r[2] for r in results) and not BIN["gs"]:
         raise RuntimeError("ضغط PDF غير متاح (لا gs)، حاول نسبة أقل أو فعّل gs.")
+    keep = out_path.with_name(out_path.stem.replace("_compressed", "") + "_compressed_keep.pdf")
+    shutil.copy2(in_path, keep)
+    return keep
+
+def _bitrate_budget(target_bytes: int, duration: float) -> int:
+    """معدل البت (bit/s) الذي يجعل ملفاً مدته duration ضمن target_bytes، مع هامش 4% للحاوية."""
+    return int(target_bytes * 8 * 0.96 / duration)
+
+def _cleanup_passlogs(passlog: Path) -> None:
+    for p in passlog.parent.glob(passlog.name + "*"):
+        p.unlink(missing_ok=True)
+
+async def _encode_audio_to_size(in_path: Path, dst: Path, target: int, info: dict) -> Path:
+    dur = info.get("duration") or 0
+    if dur <= 0:
+        raise RuntimeError("تعذر معرفة مدة الملف الصوتي")
+    budget = _bitrate_budget(target, dur)
+    fitting = [b for b in (320,256,192,160,128,112,96,80,64,48,32) if b * 1000 <= budget]
+    if not fitting:
+        raise RuntimeError(f"الملف أطول من أن يُضغط إلى {target // 1024 // 1024}MB")
+    br = fitting[0]
+    cmd = [BIN["ffmpeg"], "-y", "-i", in_path.as_posix(), "-vn", "-b:a", f"{br}k", dst.as_posix()]
+    code, out, err = await run_cmd(cmd, duration=dur)
+    if code != 0 or not dst.exists():
+        raise RuntimeError(err or out)
+    if dst.stat().st_size > target:
+        raise RuntimeError(f"الناتج تجاوز {target // 1024 // 1024}MB")
+    MEDIA_PATHS["transcode"] += 1
+    log.info("[ffmpeg] audio target=%dMB br=%dk size=%.2fMB", target // 1024 // 1024, br, dst.stat().st_size / 1024 / 1024)
+    return dst
+
+async def _encode_video_to_size(in_path: Path, dst: Path, target: int, info: dict) -> Path:
+    dur = info.get("duration") or 0
+    if dur <= 0:
+        raise RuntimeError("تعذر معرفة مدة الفيديو")
+    total = _bitrate_budget(target, dur)
+    abr = min(128_000, max(32_000, total // 8))
+    passlog = dst.with_suffix(".passlog")
+    try:
+        for _ in range(2):
+            vbr = total - abr
+            if vbr < 100_000:
+                raise RuntimeError(f"الفيديو أطول من أن يُضغط إلى {target // 1024 // 1024}MB")
+            common = ["-c:v", "libx264", "-preset", "veryfast", "-b:v", str(vbr),
+                      "-maxrate", str(int(vbr * 1.5)), "-bufsize", str(vbr * 2),
+                      "-passlogfile", passlog.as_posix()]
+            pass1 = [BIN["ffmpeg"], "-y", "-i", in_path.as_posix(), *common, "-pass", "1", "-an", "-f", "null", os.devnull]
+            pass2 = [BIN["ffmpeg"], "-y", "-i", in_path.as_posix(), *common, "-pass", "2",
+                     "-c:a", "aac", "-b:a", str(abr), "-movflags", "+faststart", dst.as_posix()]
+            for cmd in (pass1, pass2):
+                code, out, err = await run_cmd(cmd, timeout=3600, duration=dur)
+                if code != 0:
+                    raise RuntimeError(err or out)
+            size = dst.stat().st_size
+            log.info("[ffmpeg] video target=%dMB vbr=%dk size=%.2fMB",
+                     target // 1024 // 1024, vbr // 1000, size / 1024 / 1024)
+            if size <= target:
+                MEDIA_PATHS["transcode"] += 1
+                return dst
+            # تجاوز بسيط: نخفض الميزانية بنسبة التجاوز ونعيد مرة واحدة
+            total = int(total * target / size * 0.95)
+    finally:
+        _cleanup_passlogs(passlog)
+    raise RuntimeError(f"تعذر ضغط الفيديو إلى أقل من {target // 1024 // 1024}MB")
 
-async def compress_audio(in_path: Path, pct: int, out_path: Path):
+async def compress_audio(in_path: Path, pct: int, out_path: Path, target_size: Optional[int] = None):
     if not BIN["ffmpeg"]:
         raise RuntimeError("ffmpeg غير متوفر")
     br = _map_audio_bitrate(pct)
     dst = out_path.with_suffix(".mp3")
-    cmd = [BIN["ffmpeg"], "-y", "-i", in_path.as_posix(), "-vn", "-b:a", f"{br}k", dst.as_posix()]
-    code, out, err = await run_cmd(cmd)
+    info = await probe_media(in_path)
+    if target_size:
+        return await _encode_audio_to_size(in_path, dst, target_size, info)
+    # MP3 بمعدل أقل من المطلوب أصلاً: إعادة الترميز لن تصغّره، فننسخ التدفق
+    copy = info.get("acodec") == "mp3" and 0 < info.get("abitrate", 0) <= br * 1000
+    acodec = ["-c:a", "copy"] if copy else ["-b:a", f"{br}k"]
+    cmd = [BIN["ffmpeg"], "-y", "-i", in_path.as_posix(), "-vn", *acodec, dst.as_posix()]
+    code, out, err = await run_cmd(cmd, duration=info.get("duration") or 0)
     if code != 0 or not dst.exists():
         raise RuntimeError(err or out)
+    MEDIA_PATHS["copy" if copy else "transcode"] += 1
+    if dst.stat().st_size > TG_LIMIT:
+        # النسبة المختارة لا تكفي للإرسال: نعيد بالمعدل الذي يضمن الحد بدل فشل الرفع
+        log.info("[ffmpeg] audio %.2fMB over limit, re-encoding to fit", dst.stat().st_size / 1024 / 1024)
+        return await _encode_audio_to_size(in_path, dst, TG_LIMIT, info)
     return dst
 
-async def compress_video(in_path: Path, pct: int, out_path: Path):
+async def compress_video(in_path: Path, pct: int, out_path: Path, target_size: Optional[int] = None):
     if not BIN["ffmpeg"]:
         raise RuntimeError("ffmpeg غير متوفر")
     crf = _map_video_crf(pct)
     dst = out_path.with_suffix(".mp4")
+    info = await probe_media(in_path)
+    if target_size:
+        return await _encode_video_to_size(in_path, dst, target_size, info)
+    # الصوت AAC بمعدل 128k أو أقل لا يستفيد من إعادة الترميز
+    copy_audio = info.get("acodec") == "aac" and 0 < info.get("abitrate", 0) <= 128000
+    acodec = ["-c:a", "copy"] if copy_audio else ["-c:a", "aac", "-b:a", "128k"]
     cmd = [
         BIN["ffmpeg"], "-y", "-i", in_path.as_posix(),
         "-c:v", "libx264", "-preset", "veryfast", "-crf", str(crf),
-        "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart",
+        *acodec, "-movflags", "+faststart",
         dst.as_posix()
     ]
-    code, out, err = await run_cmd(cmd, timeout=3600)
+    code, out, err = await run_cmd(cmd, timeout=3600, duration=info.get("duration") or 0)
     if code != 0 or not dst.exists():
         raise RuntimeError(err or out)
+    MEDIA_PATHS["copy_audio" if copy_audio else "transcode"] += 1
+    if dst.stat().st_size > TG_LIMIT:
+        log.info("[ffmpeg] video %.2fMB over limit, re-encoding to fit", dst.stat().st_size / 1024 / 1024)
+        return await _encode_video_to_size(in_path, dst, TG_LIMIT, info)
     return dst
 
+async def _to_mp4(in_path: Path, out_path: Path, plan: str):
+    vcodec = ["-c:v", "copy"] if plan != "transcode" else ["-c:v", "libx264", "-preset", "veryfast"]
+    acodec = ["-c:a", "copy"] if plan == "copy" else ["-c:a", "aac"]
+    cmd = [BIN["ffmpeg"], "-y", "-i", in_path.as_posix(), *vcodec, *acodec,
+           "-movflags", "+faststart", out_path.as_posix()]
+    code, out, err = await run_cmd(cmd, timeout=1800)
+    if code != 0 and plan != "transcode":
+        # الحاوية أو التدفقات لا تقبل النسخ المباشر: نعود للترميز الكامل
+        log.warning("[ffmpeg] %s to mp4 failed, transcoding: %s", plan, (err or out)[-300:])
+        return await _to_mp4(in_path, out_path, "transcode")
+    if code != 0:
+        raise RuntimeError(err or out)
+    MEDIA_PATHS[plan] += 1
+    log.info("[ffmpeg] to_mp4 path=%s", plan)
+
 async def compress_other_zip(in_path: Path, pct: int, out_path: Path):
-    import zipfile
     lvl = min(9, max(1, round((pct/100)*9)))
     dst = out_path.with_suffix(".zip")
     with zipfile.ZipFile(dst, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=lvl) as z:
         z.write(in_path.as_posix(), arcname=in_path.name)
     return dst
 
+# ======== الإرسال إلى تيليجرام ========
+
+PRI_STATUS, PRI_MSG, PRI_UPLOAD = 0, 1, 2
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+class Outbox:
+    """طبقة الإرسال للمهام: ميزانية عامة ولكل محادثة، احترام retry_after، وإعادة أخطاء الشبكة
+    دون إعادة المعالجة. make تُستدعى من جديد في كل محاولة (الرفع يعيد فتح الملف)."""
+
+    def __init__(self, rate: float, chat_rate: float, conc: int, upload_conc: int, max_queue: int, retries: int):
+        self.interval = 1.0 / rate
+        self.chat_interval = 1.0 / chat_rate
+        self.retries = retries
+        self._free = conc
+        self._waiters: list = []        # heap: (priority, seq, future)
+        self._seq = 0
+        self._room = asyncio.Semaphore(max_queue)
+        self._uploads = asyncio.Semaphore(upload_conc)
+        self._next_global = 0.0
+        self._next_chat: Dict[int, float] = {}
+        self.sent = self.retried = self.flood_waits = self.dropped = 0
+
+    def _wait_for(self, chat_id: int) -> float:
+        now = time.monotonic()
+        return max(self._next_global, self._next_chat.get(chat_id, 0.0)) - now
+
+    async def _pace(self, chat_id: int) -> None:
+        now = time.monotonic()
+        start = max(now, self._next_global, self._next_chat.get(chat_id, 0.0))
+        self._next_global = max(self._next_global, start) + self.interval
+        self._next_chat[chat_id] = start + self.chat_interval
+        if len(self._next_chat) > 10000:
+            self._next_chat = {c: t for c, t in self._next_chat.items() if t > now}
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def _acquire(self, priority: int) -> None:
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._free += 1
+
+    async def send(self, chat_id: int, make, priority: int = PRI_MSG, droppable: bool = False, paced: bool = True):
+        """droppable: تحديثات يمكن الاستغناء عنها (التقدم، مؤشر الكتابة) تُسقط بدل الانتظار.
+        paced=False لما لا يُحسب من حصة الرسائل (مؤشر الكتابة)."""
+        if droppable and (self._room.locked() or self._wait_for(chat_id) > self.chat_interval):
+            self.dropped += 1
+            return None
+        async with self._room:
+            if priority == PRI_UPLOAD:
+                await self._uploads.acquire()
+            try:
+                return await self._send(chat_id, make, priority, droppable, paced)
+            finally:
+                if priority == PRI_UPLOAD:
+                    self._uploads.release()
+
+    async def _send(self, chat_id: int, make, priority: int, droppable: bool, paced: bool):
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            if paced:
+                await self._pace(chat_id)
+            await self._acquire(priority)
+            backoff = 0.0
+            try:
+                result = await make()
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                # لا نحجز المقعد أثناء الانتظار؛ _pace تؤخر كل ما يذهب لهذه المحادثة
+                delay = _retry_after_seconds(e) + 0.5
+                self.flood_waits += 1
+                self._next_chat[chat_id] = max(self._next_chat.get(chat_id, 0.0), time.monotonic() + delay)
+                log.warning("[out] 429 chat=%s retry_after=%.1fs", chat_id, delay)
+                if droppable:
+                    self.dropped += 1
+                    return None
+                if last:
+                    raise
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if last or droppable:
+                    raise
+                backoff = min(30.0, 2.0 ** attempt)
+                log.warning("[out] network error chat=%s (%s), retry in %.0fs", chat_id, e, backoff)
+            finally:
+                self._release()
+            self.retried += 1
+            if backoff:
+                await asyncio.sleep(backoff)
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "retries": self.retried, "flood_waits": self.flood_waits,
+                "dropped": self.dropped, "queued": len(self._waiters)}
+
+OUTBOX = Outbox(TG_GLOBAL_RATE, TG_CHAT_RATE, TG_OUT_CONC, TG_UPLOAD_CONC, TG_OUT_QUEUE, TG_SEND_RETRIES)
+
+# ======== كاش النتائج ========
+# نخزّن file_id الذي أعاده تيليجرام للناتج؛ إعادة الإرسال به لا تتطلب معالجة ولا رفعاً.
+
+class ResultCache:
+    def __init__(self, max_items: int, ttl: int, db_path: str = ""):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._mem: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self.hits = self.misses = self.disk_hits = 0
+        self._puts = 0
+        self._db: Optional[sqlite3.Connection] = None
+        if db_path:
+            try:
+                Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, file_id TEXT, ts REAL)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                log.warning("result cache db disabled: %s", e)
+                self._db = None
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        ent = self._mem.get(key)
+        if ent and now - ent[1] <= self.ttl:
+            self._mem.move_to_end(key)
+            self.hits += 1
+            return ent[0]
+        if ent:
+            del self._mem[key]
+        if self._db is not None:
+            row = self._db.execute("SELECT file_id, ts FROM results WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.ttl:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+        self.misses += 1
+        return None
+
+    def _remember(self, key: str, file_id: str, ts: float) -> None:
+        self._mem[key] = (file_id, ts)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_items:
+            self._mem.popitem(last=False)
+
+    def put(self, key: str, file_id: str) -> None:
+        now = time.time()
+        self._remember(key, file_id, now)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, file_id, now))
+            self._puts += 1
+            if self._puts % 100 == 0:
+                self._db.execute("DELETE FROM results WHERE ts < ?", (now - self.ttl,))
+            self._db.commit()
+
+    def drop(self, key: str) -> None:
+        self._mem.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._db.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "rate": (self.hits / total) if total else 0.0,
+            "size": len(self._mem),
+        }
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_DB)
+
+def _sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+async def result_key(job: Job, op: str) -> Optional[str]:
+    if job.parts and all(p.file_unique_id for p in job.parts):
+        ids = hashlib.sha256("|".join(p.file_unique_id for p in job.parts).encode()).hexdigest()
+        return f"album:{ids}:{op}"
+    if job.file_unique_id:
+        return f"{job.file_unique_id}:{op}"
+    if job.file_path and job.file_path.exists() and not (job.fetch and not job.fetch.done()):
+        if not job.content_hash:
+            job.content_hash = await asyncio.to_thread(_sha256_file, job.file_path)
+        return f"sha256:{job.content_hash}:{op}"
+    return None
+
+async def send_cached(update: Update, key: Optional[str]) -> bool:
+    file_id = RESULT_CACHE.get(key) if key else None
+    if not file_id:
+        return False
+    chat = update.effective_chat
+    try:
+        await OUTBOX.send(chat.id, lambda: chat.send_document(document=file_id, caption=tr(update, "sent")),
+                          priority=PRI_UPLOAD)
+        return True
+    except Exception as e:
+        log.warning("cached file_id rejected (%s): %s", key, e)
+        RESULT_CACHE.drop(key)
+        return False
+
+class ResultTooBig(RuntimeError):
+    pass
+
+async def send_result(update: Update, key: Optional[str], out_path: Path, kind: str = "", op: str = "") -> Optional[str]:
+    chat = update.effective_chat
+    # ZIP ألبوم مجمّع أو ناتج لم يصغر بما يكفي: تيليجرام سيرفضه بعد رفع طويل
+    if out_path.stat().st_size > TG_LIMIT:
+        raise ResultTooBig()
+    await OUTBOX.send(chat.id, lambda: chat.send_action(ChatAction.UPLOAD_DOCUMENT),
+                      priority=PRI_STATUS, droppable=True, paced=False)
+
+    async def upload():
+        # يُعاد فتح الملف في كل محاولة: المحاولة الفاشلة تكون قد استهلكت المقبض
+        with out_path.open("rb") as f:
+            return await chat.send_document(
+                document=InputFile(f, filename=out_path.name),
+                caption=tr(update, "sent"),
+            )
+
+    t0 = time.monotonic()
+    sent = await OUTBOX.send(chat.id, upload, priority=PRI_UPLOAD)
+    METRICS.observe("convbot_stage_seconds", time.monotonic() - t0, stage="upload", kind=kind, code=op)
+    if WORKQ is not None:
+        await WORKQ.delivered(out_path)
+    if not sent.document:
+        return None
+    if key:
+        RESULT_CACHE.put(key, sent.document.file_id)
+    return sent.document.file_id
+
+# ======== دمج الطلبات المتطابقة المتزامنة ========
+
+class _Flight:
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0                  # ينتظرون انتهاء المعالجة
+        self.holders = 0                  # لم ينتهوا من التسليم بعد
+        self.upload = asyncio.Lock()      # أول من يصل يرفع، والبقية يرسلون file_id من الكاش
+        self.on_idle: list = []
+
+class SingleFlight:
+    """طلبات متزامنة بنفس المفتاح تنتظر معالجة واحدة وتتشارك ناتجها (أو خطأه).
+    التسليم لكل منتظر على حدة، فمن ألغى لا يصله شيء."""
+
+    def __init__(self):
+        self._calls: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def acquire(self, key: str, fn) -> _Flight:
+        flight = self._calls.get(key)
+        if flight is None:
+            flight = self._calls[key] = _Flight(asyncio.ensure_future(fn()))
+            # نستهلك الاستثناء حتى لا يُسجَّل إن ألغى الجميع قبل قراءته
+            flight.task.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.leaders += 1
+        else:
+            self.shared += 1
+        flight.holders += 1
+        return flight
+
+    async def wait(self, flight: _Flight):
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # إلغاء المنتظر لا يلغي المعالجة المشتركة إلا إذا كان آخر من ينتظرها
+            if not flight.task.done() and flight.waiters == 1:
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def release(self, key: str, flight: _Flight) -> None:
+        flight.holders -= 1
+        if flight.holders > 0:
+            return
+        if self._calls.get(key) is flight:
+            del self._calls[key]
+        for cb in flight.on_idle:
+            cb()
+
+    def busy(self, key: Optional[str]) -> Optional[_Flight]:
+        return self._calls.get(key) if key else None
+
+FLIGHTS = SingleFlight()
+
+def cleanup_after(token: str, key: Optional[str]) -> None:
+    # منتظرون آخرون ما زالوا يعالجون أو يرفعون من ملفات هذه المهمة: نؤجل الحذف حتى ينتهوا
+    flight = FLIGHTS.busy(key)
+    if flight is not None:
+        flight.on_idle.append(lambda: cleanup_job(token))
+    else:
+        cleanup_job(token)
+
+async def deliver(update: Update, key: Optional[str], produce, kind: str = "", op: str = "") -> None:
+    """produce تعالج وتعيد مسار الناتج؛ تُنفَّذ مرة واحدة لكل مفتاح، ويرفع كل منتظر لنفسه."""
+    if key is None:
+        await send_result(update, None, await produce(), kind, op)
+        return
+    flight = FLIGHTS.acquire(key, produce)
+    try:
+        out = await FLIGHTS.wait(flight)
+        async with flight.upload:
+            if not await send_cached(update, key):
+                await send_result(update, key, out, kind, op)
+    finally:
+        FLIGHTS.release(key, flight)
+
 # ======== كولباك لاختيار القسم/التحويل/الضغط ========
 
-def _percent_keyboard(token: str, update: Update) -> InlineKeyboardMarkup:
+def _percent_keyboard(token: str, update: Update, kind: str = "") -> InlineKeyboardMarkup:
     steps = [10,20,30,40,50,60,70,80,90]
     rows, row = [], []
     for s in steps:
@@ -633,6 +2833,8 @@ def _percent_keyboard(token: str, update: Update) -> InlineKeyboardMarkup:
         if len(row) == 3:
             rows.append(row); row = []
     if row: rows.append(row)
+    if kind in ("video", "audio") and BIN["ffmpeg"]:
+        rows.append([InlineKeyboardButton(tr(update, "fit_btn", mb=TG_LIMIT_MB), callback_data=f"zip:{token}:fit")])
     return InlineKeyboardMarkup(rows)
 
 async def cb_mode(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -642,13 +2844,16 @@ async def cb_mode(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         _, token, mode = q.data.split(":")
     except Exception:
         return
-    job = JOBS.get(token)
+    job = await JOBS.get(token)
     if not job or job.user_id != q.from_user.id:
         await q.edit_message_text("انتهت صلاحية العملية. أعد إرسال الملف.")
         return
 
+    # المستخدم أظهر نيته: نبدأ التنزيل في الخلفية بينما يختار العملية
+    prefetch_job(job, ctx.bot)
+
     if mode == "conv":
-        options = conv_options(job.kind)
+        options = batch_conv_options(job) if job.parts else conv_options(job.kind)
         if not options:
             await q.edit_message_text("لا توجد تحويلات مناسبة لهذا النوع حالياً.")
             return
@@ -660,99 +2865,267 @@ async def cb_mode(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if row: kb.append(row)
         await q.edit_message_text(tr(update, "choose_action"), reply_markup=InlineKeyboardMarkup(kb))
     else:
-        await q.edit_message_text(tr(update, "choose_ratio"), reply_markup=_percent_keyboard(token, update))
+        await q.edit_message_text(tr(update, "choose_ratio"), reply_markup=_percent_keyboard(token, update, "" if job.parts else job.kind))
 
-async def cb_convert(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    global STATS_C
+async def cb_cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
     try:
-        _, token, code = q.data.split(":")
+        _, token = q.data.split(":")
     except Exception:
         return
+    prog = RUNNING.get(token)
+    if not prog:
+        return
+    if prog.update.effective_user.id != q.from_user.id:
+        return
+    prog.cancel()
+    try:
+        await q.edit_message_text(tr(update, "cancelled"))
+    except Exception as e:
+        log.debug("cancel edit failed: %s", e)
 
-    job = JOBS.get(token)
+async def _claim_job(update: Update, token: str) -> Optional[Job]:
+    """يحجز المهمة لعملية واحدة: ضغطة مزدوجة أو خيار ثانٍ قبل تعديل الأزرار لا يبدأ تنفيذاً آخر
+    على نفس المجلد. الحجز يتم قبل أي انتظار."""
+    q = update.callback_query
+    job = await JOBS.get(token)
+    if job and job.user_id == q.from_user.id:
+        if job.busy:
+            await q.answer(tr(update, "busy"))
+            return None
+        job.busy = True
+    await q.answer()
     if not job:
         await q.edit_message_text("انتهت صلاحية هذه العملية، أعد إرسال الملف.")
-        return
+        return None
     if job.user_id != q.from_user.id:
         await q.edit_message_text("هذه العملية ليست لك.")
-        return
-
-    await q.edit_message_text(tr(update, "working"))
+        return None
+    return job
 
+async def cb_convert(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
     try:
-        out_path = await do_convert(job, code)
-        await update.effective_chat.send_action(ChatAction.UPLOAD_DOCUMENT)
-        with out_path.open("rb") as f:
-            await update.effective_chat.send_document(
-                document=InputFile(f, filename=out_path.name),
-                caption=tr(update, "sent"),
-            )
-    except Exception as e:
-        log.exception("conversion error")
-        await update.effective_chat.send_message(tr(update, "failed", err=str(e)[:200]))
-    finally:
-        try:
-            if job.file_path.exists():
-                job.file_path.unlink(missing_ok=True)
-            if job.file_path.parent.exists():
-                shutil.rmtree(job.file_path.parent, ignore_errors=True)
-        except Exception:
-            pass
-        JOBS.pop(token, None)
+        _, token, code = q.data.split(":")
+    except Exception:
+        await q.answer()
+        return
 
-    STATS_C += 1
+    job = await _claim_job(update, token)
+    if job:
+        spawn(run_job(update, ctx, token, job, f"conv:{code}"))
 
 async def cb_compress(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    global STATS_C
     q = update.callback_query
-    await q.answer()
     try:
-        _, token, pct = q.data.split(":")
-        pct = int(pct)
+        _, token, raw = q.data.split(":")
+        # fit: ضغط بحجم مستهدف يضمن أن الناتج ضمن حد الإرسال
+        if raw != "fit":
+            int(raw)
     except Exception:
+        await q.answer()
         return
 
-    job = JOBS.get(token)
-    if not job:
-        await q.edit_message_text("انتهت صلاحية هذه العملية، أعد إرسال الملف.")
-        return
-    if job.user_id != q.from_user.id:
-        await q.edit_message_text("هذه العملية ليست لك.")
-        return
+    job = await _claim_job(update, token)
+    if job:
+        spawn(run_job(update, ctx, token, job, f"zip:{raw}"))
 
-    await q.edit_message_text(tr(update, "working"))
+async def run_job(update: Update, ctx: ContextTypes.DEFAULT_TYPE, token: str, job: Job, op: str):
+    """تنفيذ العملية في مهمة خلفية: المعالج أعاد مسبقاً فلا يُحجز قفل المستخدم طوال المعالجة."""
+    q = update.callback_query
+    prog = Progress(update, token)
+    RUNNING[token] = prog
+    ctx_token = PROGRESS.set(prog)
+    key: Optional[str] = None
+
+    async def produce() -> Path:
+        await ensure_downloaded(job, ctx.bot)
+        return await execute(job, op, update, key)
 
     try:
-        out_path = await do_compress(job, pct)
-        await update.effective_chat.send_action(ChatAction.UPLOAD_DOCUMENT)
-        with out_path.open("rb") as f:
-            await update.effective_chat.send_document(
-                document=InputFile(f, filename=out_path.name),
-                caption=tr(update, "sent"),
-            )
+        key = await result_key(job, op)
+        # إصابة كاش: لا معالجة، يبقى التعديل النهائي (عبر OUTBOX) والتنظيف في finally
+        if not await send_cached(update, key):
+            await OUTBOX.send(update.effective_chat.id, lambda: q.edit_message_text(tr(update, "working"), reply_markup=prog.markup()),
+                              priority=PRI_STATUS)
+            if key is None:
+                await ensure_downloaded(job, ctx.bot)
+                key = await result_key(job, op)
+            if not await send_cached(update, key):
+                await deliver(update, key, produce, job.kind, op)
+        await prog.finish(tr(update, "sent"))
+    except asyncio.CancelledError:
+        if not prog.cancelled:
+            raise
+        log.info("[cancel] %s %s cancelled by user", op, token)
+    except ResultTooBig:
+        log.info("%s result over %dMB", op, TG_LIMIT_MB)
+        await prog.finish()
+        await OUTBOX.send(update.effective_chat.id,
+                          lambda: update.effective_chat.send_message(tr(update, "file_too_big", mb=TG_LIMIT_MB)))
     except Exception as e:
-        log.exception("compress error")
+        log.exception("%s error", op)
+        await prog.finish()
         msg = str(e)[:200]
-        if job.kind == "pdf" and not BIN["gs"]:
+        if op.startswith("zip:") and job.kind == "pdf" and not BIN["gs"]:
             msg = tr(update, "no_gs")
-        await update.effective_chat.send_message(tr(update, "failed", err=msg))
+        await OUTBOX.send(update.effective_chat.id, lambda: update.effective_chat.send_message(tr(update, "failed", err=msg)))
     finally:
-        try:
-            if job.file_path.exists():
-                job.file_path.unlink(missing_ok=True)
-            if job.file_path.parent.exists():
-                shutil.rmtree(job.file_path.parent, ignore_errors=True)
-        except Exception:
-            pass
-        JOBS.pop(token, None)
+        prog.close()
+        PROGRESS.reset(ctx_token)
+        cleanup_after(token, key)
+
+    await asyncio.to_thread(STATE.incr, "stats:ops")
+
+# ======== المجدول الموزون ========
+
+# تكلفة تقديرية لكل عملية: (وحدات CPU، ذاكرة MB). المفتاح كود العملية ثم النوع.
+JOB_COST: Dict[str, Tuple[float, int]] = {
+    "image": (0.25, 128),
+    "pdf": (1.0, 384),
+    "pdf2jpg": (2.0, 384),
+    "pdf2png": (2.0, 384),
+    "pdf2docx": (2.0, 768),
+    "pdf_zip": (float(PDF_PARALLEL), 768),   # استراتيجيات ضغط PDF متوازية
+    "audio": (0.5, 64),
+    "remux": (0.25, 64),   # نسخ تدفقات بلا ترميز
+    "video": (3.0, 768),   # libx264 يستهلك عدة أنوية
+    "office": (1.0, 512),
+    "other": (0.5, 64),
+}
 
-    STATS_C += 1
+def job_cost(kind: str, op: str = "") -> Tuple[float, int]:
+    return JOB_COST.get(op) or JOB_COST.get(kind) or JOB_COST["other"]
+
+class JobScheduler:
+    """يقبل المهام حسب تكلفتها ضمن سعة CPU/الذاكرة، مع طوابير عادلة (round-robin) لكل مستخدم."""
+
+    def __init__(self, cpu_units: float, mem_mb: int):
+        self.cpu_units = cpu_units
+        self.mem_mb = mem_mb
+        self.cpu_used = 0.0
+        self.mem_used = 0
+        self.running = 0
+        self._queues: Dict[int, deque] = {}
+        self._order: deque = deque()
+        self._waits: deque = deque(maxlen=500)
+
+    def _fits(self, cpu: float, mem: int) -> bool:
+        if self.running == 0:
+            return True
+        return self.cpu_used + cpu <= self.cpu_units + 1e-9 and self.mem_used + mem <= self.mem_mb
+
+    def _take(self, cpu: float, mem: int, t0: float) -> None:
+        self.cpu_used += cpu
+        self.mem_used += mem
+        self.running += 1
+        self._waits.append(time.monotonic() - t0)
+
+    def _release(self, cpu: float, mem: int) -> None:
+        self.cpu_used = max(0.0, self.cpu_used - cpu)
+        self.mem_used = max(0, self.mem_used - mem)
+        self.running -= 1
+        self._pump()
+
+    def _pump(self) -> None:
+        # دورة واحدة لكل مستخدم في كل جولة: لا يستطيع مستخدم بخمسين ملفاً حجب الآخرين
+        progressed = True
+        while progressed and self._order:
+            progressed = False
+            for _ in range(len(self._order)):
+                uid = self._order.popleft()
+                q = self._queues[uid]
+                while q and q[0][0].done():
+                    q.popleft()
+                if not q:
+                    del self._queues[uid]
+                    continue
+                fut, cpu, mem, t0 = q[0]
+                if self._fits(cpu, mem):
+                    q.popleft()
+                    self._take(cpu, mem, t0)
+                    fut.set_result(None)
+                    progressed = True
+                if q:
+                    self._order.append(uid)
+                else:
+                    del self._queues[uid]
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, kind: str, op: str = ""):
+        cpu, mem = job_cost(kind, op)
+        cpu, mem = min(cpu, self.cpu_units), min(mem, self.mem_mb)
+        t0 = time.monotonic()
+        if not self._queues and self._fits(cpu, mem):
+            self._take(cpu, mem, t0)
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            if user_id not in self._queues:
+                self._queues[user_id] = deque()
+                self._order.append(user_id)
+            self._queues[user_id].append((fut, cpu, mem, t0))
+            self._pump()
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._release(cpu, mem)
+                raise
+        t1 = time.monotonic()
+        METRICS.observe("convbot_stage_seconds", t1 - t0, stage="queue_wait", kind=kind, code=op)
+        width = max(1, int(cpu + 0.5))
+        share = CPU_SHARE.set((asyncio.Semaphore(width), width))
+        try:
+            yield
+        finally:
+            CPU_SHARE.reset(share)
+            self._release(cpu, mem)
+            METRICS.observe("convbot_stage_seconds", time.monotonic() - t1, stage="convert", kind=kind, code=op)
+
+    def queue_depth(self) -> int:
+        return sum(1 for q in self._queues.values() for w in q if not w[0].done())
+
+    def stats(self) -> dict:
+        waits = list(self._waits)
+        return {
+            "running": self.running,
+            "queued": self.queue_depth(),
+            "cpu_used": round(self.cpu_used, 2),
+            "cpu_units": self.cpu_units,
+            "mem_used_mb": self.mem_used,
+            "mem_mb": self.mem_mb,
+            "wait_avg": (sum(waits) / len(waits)) if waits else 0.0,
+            "wait_max": max(waits) if waits else 0.0,
+        }
+
+SCHEDULER = JobScheduler(SCHED_CPU_UNITS, SCHED_MEM_MB)
 
 # ======== تنفيذ التحويل/الضغط ========
 
+def _zip_files(files: list, out_zip: Path):
+    with zipfile.ZipFile(out_zip, "w", compression=zipfile.ZIP_STORED) as z:
+        for p in files:
+            z.write(p, arcname=p.name)
+
+async def do_batch(job: Job, run_part, label: str) -> Path:
+    """ينفّذ run_part لكل عنصر بالتوازي (المجدول يضبط الحمل) ويجمع النواتج في ZIP واحد."""
+    outs = await asyncio.gather(*(run_part(p) for p in job.parts))
+    out_zip = job.file_path.parent / f"{job.file_name}_{label}.zip"
+    await asyncio.to_thread(_zip_files, outs, out_zip)
+    return out_zip
+
 async def do_convert(job: Job, code: str) -> Path:
+    if job.parts:
+        if code == "imgs2pdf":
+            out_path = job.file_path.parent / f"{job.file_name}.pdf"
+            async with SCHEDULER.slot(job.user_id, "pdf"):
+                pdfs = [p.file_path.with_suffix(".page.pdf") for p in job.parts]
+                await asyncio.gather(*(image_to_pdf(p.file_path, o) for p, o in zip(job.parts, pdfs)))
+                await CPU_POOL.run(_merge_pdfs, pdfs, out_path, timeout=600)
+            return out_path
+        return await do_batch(job, lambda p: do_convert(p, code), code)
+
     ext_map = {
         "to_png": ".png", "to_jpg": ".jpg", "to_webp": ".webp",
         "img2pdf": ".pdf", "pdf2jpg": ".zip", "pdf2png": ".zip",
@@ -762,7 +3135,7 @@ async def do_convert(job: Job, code: str) -> Path:
     out_path = job.file_path.parent / (Path(job.file_name).stem + ext_map.get(code, ".out"))
 
     if job.kind == "image":
-        async with SEM_IMAGE:
+        async with SCHEDULER.slot(job.user_id, job.kind, code):
             if code == "img2pdf":
                 await image_to_pdf(job.file_path, out_path)
             elif code in ("to_png", "to_jpg", "to_webp"):
@@ -771,47 +3144,49 @@ async def do_convert(job: Job, code: str) -> Path:
                 raise RuntimeError("Unsupported image conversion")
 
     elif job.kind == "pdf":
-        async with SEM_PDF:
+        async with SCHEDULER.slot(job.user_id, job.kind, code):
             if code == "pdf2jpg":
                 await pdf_to_images_zip(job.file_path, "jpg", out_path)
             elif code == "pdf2png":
                 await pdf_to_images_zip(job.file_path, "png", out_path)
             elif code == "pdf2docx":
-                await pdf_to_docx(job.file_path, out_path)
+                done, total = await pdf_to_docx(job.file_path, out_path,
+                                                progress=lambda d, t: report_progress(d, t, pages=True))
+                if done < total:
+                    # ناتج جزئي (سقف الصفحات أو المهلة): الاسم يوضّح النطاق
+                    out_path = out_path.rename(out_path.with_name(f"{out_path.stem}_pages_1-{done}.docx"))
             else:
                 raise RuntimeError("Unsupported pdf conversion")
 
     elif job.kind == "audio":
         if not BIN["ffmpeg"]:
             raise RuntimeError("ffmpeg غير متوفر")
-        async with SEM_MEDIA:
-            if code in ("to_mp3", "to_wav", "to_ogg"):
-                acodec = {"to_mp3": "libmp3lame", "to_wav": "pcm_s16le", "to_ogg": "libvorbis"}[code]
-                cmd = [BIN["ffmpeg"], "-y", "-i", job.file_path.as_posix(),
-                       "-vn", "-acodec", acodec, out_path.as_posix()]
-                code_, out, err = await run_cmd(cmd)
-                if code_ != 0:
-                    raise RuntimeError(err or out)
-            else:
-                raise RuntimeError("Unsupported audio conversion")
+        if code not in ("to_mp3", "to_wav", "to_ogg"):
+            raise RuntimeError("Unsupported audio conversion")
+        # نفس الترميز المطلوب: نسخ التدفق بدل فك الترميز وإعادته
+        same = {"to_mp3": "mp3", "to_wav": "pcm_s16le", "to_ogg": "vorbis"}[code]
+        info = await probe_media(job.file_path)
+        copy = info.get("acodec") == same
+        async with SCHEDULER.slot(job.user_id, job.kind, "remux" if copy else code):
+            acodec = "copy" if copy else {"to_mp3": "libmp3lame", "to_wav": "pcm_s16le", "to_ogg": "libvorbis"}[code]
+            cmd = [BIN["ffmpeg"], "-y", "-i", job.file_path.as_posix(),
+                   "-vn", "-acodec", acodec, out_path.as_posix()]
+            code_, out, err = await run_cmd(cmd)
+            if code_ != 0:
+                raise RuntimeError(err or out)
+            MEDIA_PATHS["copy" if copy else "transcode"] += 1
 
     elif job.kind == "video":
         if not BIN["ffmpeg"]:
             raise RuntimeError("ffmpeg غير متوفر")
-        async with SEM_MEDIA:
-            if code == "to_mp4":
-                cmd = [BIN["ffmpeg"], "-y", "-i", job.file_path.as_posix(),
-                       "-c:v", "libx264", "-preset", "veryfast",
-                       "-c:a", "aac", "-movflags", "+faststart",
-                       out_path.as_posix()]
-                code_, out, err = await run_cmd(cmd, timeout=1800)
-                if code_ != 0:
-                    raise RuntimeError(err or out)
-            else:
-                raise RuntimeError("Unsupported video conversion")
+        if code != "to_mp4":
+            raise RuntimeError("Unsupported video conversion")
+        plan = _video_plan(await probe_media(job.file_path))
+        async with SCHEDULER.slot(job.user_id, job.kind, "remux" if plan != "transcode" else code):
+            await _to_mp4(job.file_path, out_path, plan)
 
     elif job.kind == "office":
-        async with SEM_OFFICE:
+        async with SCHEDULER.slot(job.user_id, job.kind, code):
             if code == "office2pdf":
                 await office_to_pdf(job.file_path, out_path)
             else:
@@ -824,21 +3199,369 @@ async def do_convert(job: Job, code: str) -> Path:
         raise RuntimeError("لم يُنتج ملف ناتج.")
     return out_path.rename(out_path.with_name(SAFE_CHARS.sub("_", out_path.name)[:128] or "out"))
 
-async def do_compress(job: Job, pct: int) -> Path:
-    base = job.file_path.parent / (Path(job.file_name).stem + f"_compressed_{pct}")
-    if job.kind == "image":
-        async with SEM_IMAGE:
+async def do_compress(job: Job, pct: int, target_size: Optional[int] = None) -> Path:
+    label = "fit" if target_size else str(pct)
+    if job.parts:
+        return await do_batch(job, lambda p: do_compress(p, pct, target_size), f"compressed_{label}")
+    base = job.file_path.parent / (Path(job.file_name).stem + f"_compressed_{label}")
+    async with SCHEDULER.slot(job.user_id, job.kind, f"{job.kind}_zip"):
+        if job.kind == "image":
             return await compress_image(job.file_path, pct, base)
-    if job.kind == "pdf":
-        async with SEM_PDF:
+        if job.kind == "pdf":
             return await compress_pdf(job.file_path, pct, base.with_suffix(".pdf"))
-    if job.kind == "audio":
-        async with SEM_MEDIA:
-            return await compress_audio(job.file_path, pct, base)
-    if job.kind == "video":
-        async with SEM_MEDIA:
-            return await compress_video(job.file_path, pct, base)
-    return await compress_other_zip(job.file_path, pct, base)
+        if job.kind == "audio":
+            return await compress_audio(job.file_path, pct, base, target_size)
+        if job.kind == "video":
+            return await compress_video(job.file_path, pct, base, target_size)
+        return await compress_other_zip(job.file_path, pct, base)
+
+# ======== طابور العمل الدائم ========
+# الواجهة (البوت) تضع المهمة في SQLite وتنتظر؛ عمليات العمّال تحجزها بعقد (lease) تجدده بالنبض.
+# عامل مات أو أُعيد نشره: ينتهي العقد فتعود المهمة للطابور. واجهة ماتت: أي واجهة حيّة تسلّم النتيجة.
+# الطابور SQLite بوضع WAL: الواجهة والعمّال على جهاز واحد فقط. WAL لا يعمل على تخزين شبكي
+# (NFS وأمثاله) لأنه يعتمد على ذاكرة مشتركة، فلا يصلح لتوزيع العمّال على عدة أجهزة.
+
+async def run_local(job: Job, op: str) -> Path:
+    action, arg = op.split(":", 1)
+    if action == "conv":
+        return await do_convert(job, arg)
+    if arg == "fit":
+        return await do_compress(job, 50, TG_LIMIT)
+    return await do_compress(job, int(arg))
+
+async def execute(job: Job, op: str, update: Update, key: Optional[str]) -> Path:
+    try:
+        if WORKQ is None:
+            out = await run_local(job, op)
+        else:
+            out = await WORKQ.run(job, op, update.effective_chat.id, key)
+    except asyncio.CancelledError:
+        METRICS.inc("convbot_jobs_total", kind=job.kind, op=op, result="cancelled")
+        raise
+    except Exception:
+        METRICS.inc("convbot_jobs_total", kind=job.kind, op=op, result="failed")
+        raise
+    size_in = sum(p.file_size for p in job.parts) if job.parts else (job.file_size or _dir_size(job.file_path))
+    size_out = out.stat().st_size
+    METRICS.inc("convbot_jobs_total", kind=job.kind, op=op, result="ok")
+    METRICS.inc("convbot_input_bytes_total", size_in, kind=job.kind, op=op)
+    METRICS.inc("convbot_output_bytes_total", size_out, kind=job.kind, op=op)
+    if size_in:
+        METRICS.observe("convbot_compression_ratio", size_out / size_in, kind=job.kind, op=op)
+    return out
+
+def _job_to_task(job: Job) -> dict:
+    d = _job_to_dict(job)
+    d["file_path"] = job.file_path.as_posix() if job.file_path else None
+    for pd, p in zip(d["parts"] or (), job.parts or ()):
+        pd["file_path"] = p.file_path.as_posix() if p.file_path else None
+    return d
+
+def _job_from_task(d: dict) -> Job:
+    paths = [p.pop("file_path", None) for p in d["parts"] or ()]
+    path = d.pop("file_path", None)
+    job = _job_from_dict(d)
+    job.file_path = Path(path) if path else None
+    for p, pp in zip(job.parts or (), paths):
+        p.file_path = Path(pp) if pp else None
+    return job
+
+class QueueProgress:
+    """بديل Progress داخل العامل: آخر قيمة تُرسل مع النبض وتعرضها الواجهة."""
+
+    def __init__(self):
+        self.value: Optional[list] = None
+
+    def report(self, done: float, total: float, pages: bool = False) -> None:
+        self.value = [done, total, pages]
+
+class WorkQueue:
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, job TEXT, chat_id INTEGER, user_id INTEGER,"
+            " cache_key TEXT, owner TEXT, state TEXT, attempts INTEGER DEFAULT 0, worker TEXT,"
+            " lease REAL DEFAULT 0, progress TEXT, result TEXT, error TEXT, created REAL, updated REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, seen REAL)")
+        self._lock = threading.Lock()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{os.urandom(3).hex()}"
+        self._waiting: Dict[int, Tuple[asyncio.Future, object]] = {}
+        self._unsent: Dict[str, int] = {}   # مسار الناتج → رقم المهمة، حتى ينجح رفعه
+
+    def _exec(self, sql: str, args=()) -> list:
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    # ---- جهة الواجهة ----
+
+    def submit(self, job: Job, op: str, chat_id: int, key: Optional[str]) -> int:
+        now = time.time()
+        return self._exec(
+            "INSERT INTO tasks (op, job, chat_id, user_id, cache_key, owner, state, created, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?) RETURNING id",
+            (op, json.dumps(_job_to_task(job)), chat_id, job.user_id, key, self.owner, now, now),
+        )[0][0]
+
+    async def run(self, job: Job, op: str, chat_id: int, key: Optional[str]) -> Path:
+        tid = await asyncio.to_thread(self.submit, job, op, chat_id, key)
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting[tid] = (fut, PROGRESS.get())
+        try:
+            out = Path(await fut)
+            self._unsent[out.as_posix()] = tid
+            return out
+        except asyncio.CancelledError:
+            # العامل يرى الحالة في نبضه التالي ويقتل المعالجة
+            self.cancel(tid)
+            raise
+        finally:
+            self._waiting.pop(tid, None)
+
+    def waiting(self) -> list:
+        return list(self._waiting)
+
+    def mark_delivered(self, tid: int) -> None:
+        self._exec("UPDATE tasks SET state = 'delivered', updated = ? WHERE id = ?", (time.time(), tid))
+
+    async def delivered(self, out: Path) -> None:
+        """الرفع نجح: المهمة انتهت. قبل ذلك تبقى 'delivering' فتُعاد إن ماتت الواجهة أثناء الرفع."""
+        tid = self._unsent.pop(out.as_posix(), None)
+        if tid is not None:
+            await asyncio.to_thread(self.mark_delivered, tid)
+
+    def cancel(self, tid: int) -> None:
+        self._exec("UPDATE tasks SET state = 'cancelled', updated = ? WHERE id = ? AND state IN ('queued', 'running')",
+                   (time.time(), tid))
+
+    def poll(self, ids: list) -> list:
+        now = time.time()
+        self._exec("INSERT OR REPLACE INTO owners (owner, seen) VALUES (?, ?)", (self.owner, now))
+        # عقد انتهى بعد آخر محاولة مسموحة: العامل يموت مع هذا الملف في كل مرة
+        self._exec("UPDATE tasks SET state = 'failed', error = 'worker lost', updated = ?"
+                   " WHERE state = 'running' AND lease < ? AND attempts >= ?", (now, now, WORK_MAX_ATTEMPTS))
+        if not ids:
+            return []
+        rows = self._exec(
+            f"SELECT id, state, progress, result, error FROM tasks WHERE id IN ({','.join('?' * len(ids))})", ids)
+        # الناتج يبقى 'delivering' حتى ينجح رفعه (delivered)؛ الفشل لا رفع له فينتهي هنا
+        for state, new in (("done", "delivering"), ("failed", "delivered")):
+            ids = [r[0] for r in rows if r[1] == state]
+            if ids:
+                self._exec(f"UPDATE tasks SET state = ?, updated = ? WHERE id IN ({','.join('?' * len(ids))})",
+                           (new, now, *ids))
+        return rows
+
+    def resolve(self, rows: list) -> None:
+        # في خيط حلقة الأحداث: المستقبلات والتقدم لا تُلمس من خيط آخر
+        for tid, state, progress, result, error in rows:
+            fut, prog = self._waiting.get(tid, (None, None))
+            if fut is None or fut.done():
+                continue
+            if state == "done":
+                fut.set_result(result)
+            elif state == "failed":
+                fut.set_exception(RuntimeError(error or "فشلت المعالجة"))
+            elif progress and prog is not None:
+                prog.report(*json.loads(progress))
+
+    def claim_orphans(self) -> list:
+        """نتائج جاهزة لواجهة لم تعد حيّة (أُعيد نشرها أثناء المعالجة أو الرفع): ننقل ملكيتها إلينا.
+        'delivering' لواجهة ميتة يعني أن رفعها لم يكتمل فيُعاد كناتج جاهز."""
+        now = time.time()
+        rows = self._exec(
+            "UPDATE tasks SET owner = ?, state = CASE state WHEN 'failed' THEN 'delivered' ELSE 'delivering' END,"
+            " updated = ? WHERE state IN ('done', 'failed', 'delivering')"
+            " AND owner NOT IN (SELECT owner FROM owners WHERE seen > ?)"
+            " RETURNING id, state, job, chat_id, user_id, cache_key, result, error",
+            (self.owner, now, now - WORK_LEASE),
+        )
+        self._exec("DELETE FROM tasks WHERE state IN ('delivered', 'cancelled') AND updated < ?", (now - 86400,))
+        self._exec("DELETE FROM owners WHERE seen < ?", (now - 86400,))
+        return rows
+
+    def counts(self) -> Dict[str, int]:
+        return dict(self._exec("SELECT state, COUNT(*) FROM tasks GROUP BY state"))
+
+    def live_dirs(self) -> set:
+        # مجلدات مهام ما زالت في الطابور: لا يحذفها الكنّاس حتى بعد إعادة تشغيل الواجهة
+        out = set()
+        for (raw,) in self._exec("SELECT job FROM tasks WHERE state IN ('queued', 'running', 'done', 'failed', 'delivering')"):
+            d = json.loads(raw)
+            for path in [d.get("file_path")] + [p.get("file_path") for p in d.get("parts") or ()]:
+                if path:
+                    out.add(Path(path).parent)
+        return out
+
+    # ---- جهة العامل ----
+
+    def claim(self, worker: str) -> Optional[tuple]:
+        now = time.time()
+        rows = self._exec(
+            "UPDATE tasks SET state = 'running', attempts = attempts + 1, worker = ?, lease = ?, updated = ?"
+            " WHERE id = (SELECT id FROM tasks WHERE (state = 'queued' OR (state = 'running' AND lease < ?))"
+            "  AND attempts < ? ORDER BY id LIMIT 1)"
+            " RETURNING id, op, job, attempts",
+            (worker, now + WORK_LEASE, now, now, WORK_MAX_ATTEMPTS),
+        )
+        return rows[0] if rows else None
+
+    def heartbeat(self, tid: int, worker: str, progress: Optional[list]) -> bool:
+        now = time.time()
+        return bool(self._exec(
+            "UPDATE tasks SET lease = ?, progress = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'running'"
+            " RETURNING id", (now + WORK_LEASE, json.dumps(progress) if progress else None, now, tid, worker)))
+
+    def finish(self, tid: int, worker: str, result: Optional[str] = None, error: Optional[str] = None) -> None:
+        self._exec(
+            "UPDATE tasks SET state = ?, result = ?, error = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            ("done" if error is None else "failed", result, error, time.time(), tid, worker))
+
+    def requeue(self, worker: str) -> None:
+        # إيقاف نظامي للعامل: المهام لا تُحتسب محاولة فاشلة
+        self._exec("UPDATE tasks SET state = 'queued', attempts = attempts - 1, worker = NULL, lease = 0"
+                   " WHERE worker = ? AND state = 'running'", (worker,))
+
+WORKQ: Optional[WorkQueue] = WorkQueue(WORK_QUEUE_DB) if WORK_QUEUE_DB else None
+
+async def _deliver_orphan(bot, row) -> None:
+    tid, state, raw, chat_id, user_id, key, result, error = row
+    path = json.loads(raw).get("file_path")
+    await LANGS.prime(user_id)
+    try:
+        if state == "delivering":
+            out = Path(result)
+            if out.stat().st_size > TG_LIMIT:
+                raise ResultTooBig()
+
+            async def upload():
+                with out.open("rb") as f:
+                    return await bot.send_document(chat_id, document=InputFile(f, filename=out.name),
+                                                   caption=tr_user(user_id, "sent"))
+
+            sent = await OUTBOX.send(chat_id, upload, priority=PRI_UPLOAD)
+            if key and sent.document:
+                RESULT_CACHE.put(key, sent.document.file_id)
+        else:
+            await OUTBOX.send(chat_id, lambda: bot.send_message(chat_id, tr_user(user_id, "failed", err=(error or "")[:200])))
+        log.info("[queue] delivered orphaned task %s (%s)", tid, state)
+    except ResultTooBig:
+        await OUTBOX.send(chat_id, lambda: bot.send_message(chat_id, tr_user(user_id, "file_too_big", mb=TG_LIMIT_MB)))
+    except Exception as e:
+        log.warning("[queue] orphan delivery %s failed: %s", tid, e)
+    finally:
+        # محاولة واحدة ثم تُحذف الملفات؛ موت الواجهة أثناء الرفع وحده يبقيها 'delivering' لغيرها
+        if state == "delivering":
+            await asyncio.to_thread(WORKQ.mark_delivered, tid)
+        if path:
+            shutil.rmtree(Path(path).parent, ignore_errors=True)
+
+async def queue_loop(bot) -> None:
+    rounds = 0
+    while True:
+        await asyncio.sleep(WORK_POLL)
+        try:
+            WORKQ.resolve(await asyncio.to_thread(WORKQ.poll, WORKQ.waiting()))
+            # أول جولة بعد الإقلاع ثم كل 20: نتائج واجهات ميتة، ومنها ما انقطع رفعه ('delivering')
+            if rounds % 20 == 0:
+                for row in await asyncio.to_thread(WORKQ.claim_orphans):
+                    asyncio.ensure_future(_deliver_orphan(bot, row))
+            rounds += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("queue poll failed")
+
+async def supervise_worker(n: int) -> None:
+    """يبقي عاملاً محلياً يعمل؛ يُعاد تشغيله إن خرج."""
+    while True:
+        env = dict(os.environ)
+        env["WORKER_INDEX"] = str(n + 1)          # 0 للواجهة نفسها
+        env["WORKER_SHARE"] = str(WORK_WORKERS)
+        if WORKER_METRICS_PORT:
+            env["WORKER_METRICS_PORT"] = str(WORKER_METRICS_PORT + n)
+        proc = await asyncio.create_subprocess_exec(sys.executable, Path(__file__).as_posix(), "worker", env=env)
+        try:
+            code = await proc.wait()
+        except asyncio.CancelledError:
+            if proc.returncode is None:
+                proc.terminate()   # SIGTERM: العامل يعيد مهامه الجارية للطابور
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=10)
+                except asyncio.TimeoutError:
+                    proc.kill()
+            raise
+        log.warning("[queue] worker %d exited with %s, restarting", n, code)
+        await asyncio.sleep(2)
+
+async def _work_task(task: tuple, worker: str) -> None:
+    tid, op, raw, attempt = task
+    job = _job_from_task(json.loads(raw))
+    log.info("[worker] task %s op=%s attempt=%d", tid, op, attempt)
+    if not job.file_path or not job.file_path.exists():
+        await asyncio.to_thread(WORKQ.finish, tid, worker, None, "الملف غير موجود على هذا العامل")
+        return
+    prog = QueueProgress()
+    PROGRESS.set(prog)
+    runner = asyncio.ensure_future(run_local(job, op))
+    try:
+        while True:
+            done, _ = await asyncio.wait({runner}, timeout=min(5.0, WORK_LEASE / 3))
+            if done:
+                break
+            if not await asyncio.to_thread(WORKQ.heartbeat, tid, worker, prog.value):
+                # أُلغيت من الواجهة أو أخذها عامل آخر بعد انقطاع
+                log.info("[worker] task %s no longer ours, stopping", tid)
+                runner.cancel()
+                await asyncio.gather(runner, return_exceptions=True)
+                return
+        out = runner.result()
+        await asyncio.to_thread(WORKQ.finish, tid, worker, out.as_posix())
+    except asyncio.CancelledError:
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        raise
+    except Exception as e:
+        log.exception("[worker] task %s failed", tid)
+        await asyncio.to_thread(WORKQ.finish, tid, worker, None, str(e)[:500] or type(e).__name__)
+
+async def worker_main() -> None:
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, main_task.cancel)
+    sem = asyncio.Semaphore(WORK_CONC)
+    running: set = set()
+    METRICS.bind(loop)
+    if WORKER_METRICS_PORT:
+        start_health_server(WORKER_METRICS_PORT)
+    log.info("[worker] %s started (conc=%d)", worker, WORK_CONC)
+    try:
+        while True:
+            await sem.acquire()
+            task = await asyncio.to_thread(WORKQ.claim, worker)
+            if task is None:
+                sem.release()
+                await asyncio.sleep(WORK_POLL)
+                continue
+            t = asyncio.ensure_future(_work_task(task, worker))
+            running.add(t)
+            t.add_done_callback(lambda t: (running.discard(t), sem.release()))
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for t in list(running):
+            t.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        WORKQ.requeue(worker)
+        CPU_POOL.shutdown()
+        await OFFICE_POOL.shutdown()
+        log.info("[worker] %s stopped", worker)
 
 # ======== تهيئة القناة/الأوامر ========
 
@@ -854,6 +3577,8 @@ async def resolve_channel(bot) -> None:
         user = val.lstrip("@")
     try:
         chat = await bot.get_chat(f"@{user}")
+        if CHANNEL_CHAT_ID != chat.id:
+            MEMBERS.invalidate()
         CHANNEL_CHAT_ID = chat.id
         CHANNEL_USERNAME_LINK = user
         log.info("[sub] channel resolved: @%s (id=%s)", user, CHANNEL_CHAT_ID)
@@ -863,6 +3588,12 @@ async def resolve_channel(bot) -> None:
         CHANNEL_USERNAME_LINK = None
 
 async def _post_init(app: Application):
+    METRICS.bind(asyncio.get_running_loop())
+    app.bot_data["gc_task"] = asyncio.create_task(gc_loop())
+    if WORKQ is not None:
+        app.bot_data["queue_tasks"] = [asyncio.create_task(queue_loop(app.bot))] + [
+            asyncio.create_task(supervise_worker(i)) for i in range(WORK_WORKERS)
+        ]
     await resolve_channel(app.bot)
     await app.bot.set_my_commands([
         BotCommand("start", "Start / اختر اللغة"),
@@ -872,6 +3603,24 @@ async def _post_init(app: Application):
         BotCommand("stats", "Admin: إحصائيات"),
     ])
 
+async def _post_shutdown(app: Application):
+    task = app.bot_data.pop("gc_task", None)
+    if task:
+        task.cancel()
+    queue_tasks = app.bot_data.pop("queue_tasks", [])
+    for t in queue_tasks:
+        t.cancel()
+    await asyncio.gather(*queue_tasks, return_exceptions=True)
+    for t in list(BACKGROUND):
+        t.cancel()
+    await asyncio.gather(*BACKGROUND, return_exceptions=True)
+    CPU_POOL.shutdown()
+    await OFFICE_POOL.shutdown()
+    if HTTP is not None:
+        await HTTP.aclose()
+    if URL_HTTP is not None:
+        await URL_HTTP.aclose()
+
 def build_app() -> Application:
     if not BOT_TOKEN:
         raise SystemExit("BOT_TOKEN is missing")
@@ -879,10 +3628,15 @@ def build_app() -> Application:
     application: Application = (
         ApplicationBuilder()
         .token(BOT_TOKEN)
+        .concurrent_updates(UserOrderedUpdateProcessor(CONC_UPDATES))
         .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
         .build()
     )
 
+    # تحميل لغة المستخدم قبل أي معالج حتى لا تنتظرها tr()
+    application.add_handler(TypeHandler(Update, prime_lang), group=-1)
+
     # أوامر
     application.add_handler(CommandHandler("start", cmd_start))
     application.add_handler(CommandHandler("help", cmd_help))
@@ -896,53 +3650,160 @@ def build_app() -> Application:
     application.add_handler(CallbackQueryHandler(cb_mode, pattern=r"^mode:.+"))
     application.add_handler(CallbackQueryHandler(cb_convert, pattern=r"^conv:.+"))
     application.add_handler(CallbackQueryHandler(cb_compress, pattern=r"^zip:.+"))
+    application.add_handler(CallbackQueryHandler(cb_cancel, pattern=r"^cancel:.+"))
+
+    # تغيّر عضوية القناة (يتطلب أن يكون البوت مشرفاً فيها)
+    application.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
 
     # استقبال ملفات
     file_filter = (filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.AUDIO)
     application.add_handler(MessageHandler(file_filter, on_file))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(URL_RE), on_url))
 
     return application
 
-# -------- health server للـ Web Service في وضع polling --------
-def start_health_server():
+# -------- مقاييس تُحسب عند القراءة --------
+
+_WORKROOT_USAGE = [0, 0.0]   # (bytes, وقت الحساب): المرور على الشجرة مكلف، نعيد الحساب كل 30ث
+
+def _workroot_bytes() -> list:
+    if time.monotonic() - _WORKROOT_USAGE[1] > 30:
+        _WORKROOT_USAGE[:] = [_dir_size(WORK_ROOT), time.monotonic()]
+    return [({}, _WORKROOT_USAGE[0])]
+
+def _stats_series(stats: dict, keys: tuple, **labels) -> list:
+    return [({**labels, "event": k}, stats[k]) for k in keys]
+
+def _register_metric_callbacks() -> None:
+    st = SCHEDULER.stats
+    METRICS.callback("convbot_scheduler_running", "gauge", "Jobs holding a scheduler slot",
+                     lambda: [({}, st()["running"])])
+    METRICS.callback("convbot_scheduler_queued", "gauge", "Jobs waiting for a scheduler slot",
+                     lambda: [({}, st()["queued"])])
+    METRICS.callback("convbot_scheduler_cpu_units", "gauge", "CPU units in use",
+                     lambda: [({}, st()["cpu_used"])])
+    METRICS.callback("convbot_jobs_pending", "gauge", "Jobs waiting for the user to pick an action",
+                     lambda: [({}, len(JOBS))])
+    METRICS.callback("convbot_jobs_inflight", "gauge", "Jobs being processed for a user",
+                     lambda: [({}, len(RUNNING))])
+    METRICS.callback("convbot_workroot_bytes", "gauge", "Disk used under WORK_ROOT", _workroot_bytes, on_loop=False)
+    METRICS.callback("convbot_result_cache_events_total", "counter", "Result cache lookups",
+                     lambda: _stats_series(RESULT_CACHE.stats(), ("hits", "misses")))
+    METRICS.callback("convbot_membership_cache_events_total", "counter", "Membership cache lookups",
+                     lambda: _stats_series(MEMBERS.stats(), ("hits", "misses", "coalesced", "stale")))
+    METRICS.callback("convbot_outbox_events_total", "counter", "Telegram sends",
+                     lambda: _stats_series(OUTBOX.stats(), ("sent", "retries", "flood_waits", "dropped")))
+    METRICS.callback("convbot_outbox_queued", "gauge", "Sends waiting for a slot",
+                     lambda: [({}, OUTBOX.stats()["queued"])])
+    METRICS.callback("convbot_ffmpeg_paths_total", "counter", "ffmpeg copy vs transcode",
+                     lambda: [({"path": k}, v) for k, v in MEDIA_PATHS.items()])
+    METRICS.callback("convbot_gc_reclaimed_bytes_total", "counter", "Bytes freed by the sweeper",
+                     lambda: [({}, GC_STATS["reclaimed_bytes"])])
+    if WORKQ is not None:
+        METRICS.callback("convbot_work_queue_tasks", "gauge", "Durable queue tasks by state",
+                         lambda: [({"state": k}, v) for k, v in WORKQ.counts().items()], on_loop=False)
+
+_register_metric_callbacks()
+
+# -------- health server: / للفحص و /metrics لـ Prometheus --------
+def start_health_server(port: int = PORT):
     class Handler(BaseHTTPRequestHandler):
         def log_message(self, format, *args):
             return
         def do_GET(self):
+            if self.path.split("?")[0] == "/metrics":
+                body = METRICS.render().encode()
+                ctype = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                body = json.dumps({"ok": True, "mode": MODE}).encode()
+                ctype = "application/json"
             self.send_response(200)
-            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Type", ctype)
             self.end_headers()
-            body = json.dumps({"ok": True, "mode": MODE}).encode()
             self.wfile.write(body)
 
     def _serve():
-        httpd = HTTPServer(("0.0.0.0", PORT), Handler)
-        log.info("[health] serving on 0.0.0.0:%s", PORT)
+        httpd = HTTPServer(("0.0.0.0", port), Handler)
+        log.info("[health] serving on 0.0.0.0:%s", port)
         httpd.serve_forever()
 
     threading.Thread(target=_serve, daemon=True).start()
 
+def webhook_app(app: Application) -> web.Application:
+    """خادم الويبهوك (aiohttp) على PORT: /webhook لتحديثات تيليجرام، و/metrics و/ على المنفذ نفسه."""
+
+    async def webhook(request: web.Request) -> web.Response:
+        try:
+            update = Update.de_json(await request.json(), app.bot)
+        except Exception:
+            return web.Response(status=400)
+        await app.update_queue.put(update)
+        return web.Response()
+
+    async def metrics(request: web.Request) -> web.Response:
+        # خارج الحلقة: مؤشرات SQLite تُقرأ في خيط، والباقي تأخذه render من الحلقة
+        body = await asyncio.to_thread(METRICS.render)
+        return web.Response(body=body.encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"ok": True, "mode": MODE})
+
+    web_app = web.Application()
+    web_app.router.add_post("/webhook", webhook)
+    web_app.router.add_get("/metrics", metrics)
+    web_app.router.add_get("/{tail:.*}", health)
+    return web_app
+
+async def serve_webhook(app: Application) -> None:
+    """بديل app.run_webhook: نفس دورة الحياة (post_init/post_shutdown) لكن بخادم aiohttp خاص بنا."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    runner = web.AppRunner(webhook_app(app), access_log=None)
+    try:
+        async with app:
+            await app.post_init(app)
+            await app.bot.set_webhook(
+                f"{PUBLIC_URL}/webhook",
+                drop_pending_updates=isinstance(STATE, MemoryState),   # مع مخزن دائم تبقى أزرار المهام صالحة
+                allowed_updates=Update.ALL_TYPES,   # chat_member لا يُرسل إلا إذا طُلب صراحة
+            )
+            await app.start()
+            try:
+                await runner.setup()
+                await web.TCPSite(runner, "0.0.0.0", PORT).start()
+                log.info("[webhook] serving /webhook and /metrics on 0.0.0.0:%s", PORT)
+                await stop.wait()
+            finally:
+                await runner.cleanup()
+                await app.stop()
+    finally:
+        await app.post_shutdown(app)
+
 # ---------- التشغيل ----------
 def main() -> None:
+    if sys.argv[1:2] == ["worker"]:
+        if WORKQ is None:
+            raise SystemExit("WORK_QUEUE_DB is missing")
+        asyncio.run(worker_main())
+        return
+    claim_work_root()
     app = build_app()
     asyncio.set_event_loop(asyncio.new_event_loop())
 
     if MODE == "webhook" and PUBLIC_URL:
         log.info("PTB version at runtime: 22.x")
         log.info("CONFIG: MODE=webhook PUBLIC_URL=%s PORT=%s", PUBLIC_URL, PORT)
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path="webhook",
-            webhook_url=f"{PUBLIC_URL}/webhook",
-            drop_pending_updates=True,
-        )
+        if METRICS_PORT:
+            start_health_server(METRICS_PORT)
+        asyncio.get_event_loop().run_until_complete(serve_webhook(app))
         return
 
     log.info("PTB version at runtime: 22.x")
     log.info("CONFIG: MODE=polling PUBLIC_URL=%s PORT=%s", PUBLIC_URL or "-", PORT)
     start_health_server()
-    app.run_polling(drop_pending_updates=True)
+    app.run_polling(drop_pending_updates=isinstance(STATE, MemoryState), allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""دوال المعالج التي تعمل في عمّال CPU_POOL، وحلقة العامل نفسه.
+
+العامل عملية مستقلة تشغّل هذا الملف مباشرة فلا تستورد bot.py: لا اتصال بالمخزن ولا طابور
+ولا telegram في كل عامل يُعاد تشغيله بعد مهلة أو إلغاء. لذلك لا شيء هنا يُنفَّذ عند الاستيراد
+غير قراءة الإعدادات، والدوال لا تعتمد إلا على معاملاتها.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import signal
+import sys
+from multiprocessing.connection import Connection
+from pathlib import Path
+from typing import Dict, Optional
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageOps
+
+log = logging.getLogger("convbot")
+
+# ضغط الصور: أقصى عدد بكسلات للناتج (ميغابكسل)
+IMG_MAX_MP = float(os.getenv("IMG_MAX_MP", "24"))
+
+# ======== تحويل ========
+
+# اتجاه EXIF → دوران الصفحة؛ الانعكاسات (2/4/5/7) تحتاج إعادة ترميز
+_EXIF_ROTATION = {1: 0, 3: 180, 6: 90, 8: 270}
+
+def _image_to_pdf(in_path: Path, out_path: Path):
+    # Image.open لا يفك الترميز؛ نقرأ الرأس فقط لنقرر إن كان التضمين المباشر ممكناً
+    with Image.open(in_path) as im:
+        fmt, mode, (w, h) = im.format, im.mode, im.size
+        orient = im.getexif().get(0x0112, 1)
+    passthrough = (fmt == "JPEG" and mode in ("RGB", "L")) or fmt == "PNG"
+    if passthrough and orient in _EXIF_ROTATION:
+        # JPEG يُضمَّن كما هو (DCTDecode) وPNG بضغط Flate بلا فقد، دون فك وإعادة ترميز
+        with fitz.open() as doc:
+            page = doc.new_page(width=w, height=h)
+            page.insert_image(page.rect, filename=in_path.as_posix())
+            if _EXIF_ROTATION[orient]:
+                page.set_rotation(_EXIF_ROTATION[orient])
+            doc.save(out_path.as_posix(), deflate=True)
+        return
+    with Image.open(in_path) as im:
+        if im.mode in ("RGBA", "P", "CMYK", "LA", "I;16"):
+            im = im.convert("RGB")
+        im.save(out_path, "PDF")
+
+def _image_convert(in_path: Path, out_path: Path):
+    with Image.open(in_path) as im:
+        if out_path.suffix.lower() in (".jpg", ".jpeg") and im.mode in ("RGBA", "P"):
+            im = im.convert("RGB")
+        im.save(out_path)
+
+def _pdf_page_count(in_path: Path) -> int:
+    with fitz.open(in_path.as_posix()) as doc:
+        return doc.page_count
+
+def _render_pdf_range(in_path: Path, fmt: str, dpi: int, start: int, end: int, out_dir: Path) -> list:
+    # صفحة واحدة في الذاكرة في كل لحظة: تُكتب على القرص ثم تُحرَّر
+    files = []
+    with fitz.open(in_path.as_posix()) as doc:
+        for i in range(start, end):
+            pix = doc.load_page(i).get_pixmap(dpi=dpi, alpha=False)
+            p = out_dir / f"page_{i + 1:03d}.{fmt}"
+            if fmt == "jpg":
+                pix.save(p.as_posix(), jpg_quality=90)
+            else:
+                pix.save(p.as_posix())
+            pix = None
+            files.append(p)
+    return files
+
+def _pdf2docx_parse_range(in_path: Path, start: int, end: int, json_path: Path):
+    # نفس ما يفعله pdf2docx في وضع multi_processing، لكن على عمّال مجمّعنا
+    from pdf2docx import Converter as Pdf2DocxConverter   # ثقيلة: فقط في العامل الذي يحتاجها
+    cv = Pdf2DocxConverter(in_path.as_posix())
+    try:
+        settings = cv.default_settings
+        cv.load_pages(start, end)
+        cv.parse_document(**settings).parse_pages(**settings).serialize(json_path.as_posix())
+    finally:
+        cv.close()
+
+def _pdf2docx_make(in_path: Path, json_paths: list, out_path: Path):
+    from pdf2docx import Converter as Pdf2DocxConverter   # ثقيلة: فقط في العامل الذي يحتاجها
+    cv = Pdf2DocxConverter(in_path.as_posix())
+    try:
+        settings = cv.default_settings
+        cv.load_pages()
+        for p in json_paths:
+            cv.deserialize(p.as_posix())
+        cv.make_docx(out_path.as_posix(), **settings)
+    finally:
+        cv.close()
+
+def _merge_pdfs(pdfs: list, out_path: Path):
+    # صفحة بصفحة: كل ملف يُفتح ويُغلق فوراً بعد إدراجه
+    with fitz.open() as out:
+        for p in pdfs:
+            with fitz.open(p.as_posix()) as src:
+                out.insert_pdf(src)
+        out.save(out_path.as_posix(), garbage=1, deflate=True)
+
+# ======== ضغط الصور ========
+
+def _map_jpeg_quality(pct: int) -> int:
+    return int(max(25, 100 - pct))
+
+def _map_webp_quality(pct: int) -> int:
+    return int(max(25, 100 - pct))
+
+def _map_png_compresslevel(pct: int) -> int:
+    return int(min(9, round((pct/100)*9)))
+
+def _map_image_scale(pct: int) -> float:
+    # حتى 40% نحافظ على الأبعاد، ثم نصغّر خطياً حتى نصف الأبعاد عند 90%
+    if pct <= 40:
+        return 1.0
+    return max(0.5, 1.0 - (pct - 40) / 100.0)
+
+def _map_image_target(pct: int, in_size: int) -> int:
+    return max(16 * 1024, int(in_size * (1 - pct / 100.0)))
+
+def _open_scaled(in_path: Path, pct: int) -> Image.Image:
+    with Image.open(in_path) as im:
+        w, h = im.size
+        scale = min(_map_image_scale(pct), (IMG_MAX_MP * 1e6 / max(1, w * h)) ** 0.5, 1.0)
+        tw, th = max(1, int(w * scale)), max(1, int(h * scale))
+        if scale < 1.0 and im.format == "JPEG":
+            # تصغير في مجال DCT أثناء فك الترميز (1/2، 1/4، 1/8): أسرع وأقل ذاكرة بكثير
+            im.draft("RGB" if im.mode not in ("RGB", "L") else im.mode, (tw, th))
+        out = im
+        if out.size != (tw, th):
+            out = out.resize((tw, th), Image.LANCZOS, reducing_gap=3.0)
+        # الناتج لا يحمل EXIF، فنطبّق الاتجاه على البكسلات (وتعيد نسخة محمّلة)
+        return ImageOps.exif_transpose(out)
+
+_SAMPLE_PX = 1_000_000   # عيّنة تقدير الحجم
+
+def _save_to_target(im: Image.Image, out_path: Path, fmt: str, target: int, q_max: int, q_min: int = 25,
+                    probe_kw: Optional[dict] = None, **save_kw) -> int:
+    """يحفظ im بأعلى جودة ≤ q_max يُتوقع أن تبقي الملف ضمن target بايت، ويعيد الجودة.
+
+    البحث يجري على عيّنة مصغّرة (≤1MP) بالبايت لكل بكسل، فالصورة الكاملة تُرمَّز مرة واحدة،
+    وتصحيحاً واحداً على الأكثر إن تجاوز الناتج الهدف (بمعامل الخطأ الفعلي للتقدير)."""
+    px = im.width * im.height
+    scale = min(1.0, (_SAMPLE_PX / max(1, px)) ** 0.5)
+    sample = im if scale >= 1.0 else im.resize(
+        (max(1, int(im.width * scale)), max(1, int(im.height * scale))), Image.BILINEAR, reducing_gap=2.0)
+    spx = sample.width * sample.height
+    bpp: Dict[int, float] = {}
+
+    def estimate(q: int) -> float:
+        if q not in bpp:
+            buf = io.BytesIO()
+            sample.save(buf, fmt, quality=q, **(probe_kw or {}))
+            bpp[q] = buf.tell() / spx
+        return bpp[q] * px
+
+    def pick(factor: float, hi: int) -> int:
+        best, lo = q_min, q_min
+        while lo <= hi:
+            q = (lo + hi) // 2
+            if estimate(q) * factor <= target:
+                best, lo = q, q + 1
+            else:
+                hi = q - 1
+        return best
+
+    q = pick(1.0, q_max)
+    im.save(out_path, fmt, quality=q, **save_kw)
+    size = out_path.stat().st_size
+    if size > target and q > q_min:
+        q = pick(size / estimate(q), q - 1)
+        im.save(out_path, fmt, quality=q, **save_kw)
+    return q
+
+def _compress_image(in_path: Path, pct: int, out_path: Path) -> Path:
+    ext = in_path.suffix.lower()
+    target = _map_image_target(pct, in_path.stat().st_size)
+    if ext in (".jpg", ".jpeg"):
+        im = _open_scaled(in_path, pct)
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        _save_to_target(im, out_path.with_suffix(".jpg"), "JPEG", target, _map_jpeg_quality(pct),
+                        optimize=True, progressive=True)
+        return out_path.with_suffix(".jpg")
+    if ext in (".webp",):
+        im = _open_scaled(in_path, pct)
+        _save_to_target(im, out_path.with_suffix(".webp"), "WEBP", target, _map_webp_quality(pct),
+                        probe_kw={"method": 4}, method=6)
+        return out_path.with_suffix(".webp")
+    im = _open_scaled(in_path, pct)
+    cl = _map_png_compresslevel(pct)
+    im.save(out_path.with_suffix(".png"), optimize=True, compress_level=cl)
+    return out_path.with_suffix(".png")
+
+# ======== PDF (PyMuPDF) ========
+
+def _fitz_deflate(in_path: Path, out_path: Path):
+    doc = fitz.open(in_path.as_posix())
+    try:
+        doc.save(out_path.as_posix(), deflate=True, garbage=3)
+    finally:
+        doc.close()
+
+def _pdf_scan(in_path: Path) -> dict:
+    # فحص سريع للموارد فقط (بلا رسم): عدد الصفحات والصور الفريدة
+    with fitz.open(in_path.as_posix()) as doc:
+        xrefs = set()
+        for page in doc:
+            xrefs.update(img[0] for img in page.get_images(full=True))
+        return {"pages": doc.page_count, "images": len(xrefs)}
+
+def _pdf_image_plan(in_path: Path) -> list:
+    """صور الملف الفريدة (حسب المحتوى) مع أكبر مساحة عرض لها بالنقاط."""
+    groups: Dict[str, dict] = {}
+    seen: Dict[int, str] = {}
+    with fitz.open(in_path.as_posix()) as doc:
+        for page in doc:
+            for img in page.get_images(full=True):
+                xref, smask, w, h, bpc = img[0], img[1], img[2], img[3], img[4]
+                if xref not in seen:
+                    if smask or bpc == 1 or w * h < 64 * 64:
+                        seen[xref] = ""   # شفافية/أحادي اللون/صغيرة: لا نلمسها
+                        continue
+                    raw = doc.xref_stream_raw(xref) or b""
+                    digest = hashlib.sha1(raw).hexdigest()
+                    seen[xref] = digest
+                    g = groups.setdefault(digest, {"xrefs": [], "w": w, "h": h, "raw": len(raw), "dw": 0.0, "dh": 0.0})
+                    g["xrefs"].append(xref)
+                digest = seen[xref]
+                if not digest:
+                    continue
+                g = groups[digest]
+                for r in page.get_image_rects(xref):
+                    g["dw"] = max(g["dw"], r.width)
+                    g["dh"] = max(g["dh"], r.height)
+    return list(groups.values())
+
+def _recompress_images(in_path: Path, items: list, dpi: int, quality: int) -> Dict[int, bytes]:
+    out: Dict[int, bytes] = {}
+    with fitz.open(in_path.as_posix()) as doc:
+        for it in items:
+            xref = it["xrefs"][0]
+            try:
+                pix = fitz.Pixmap(doc, xref)
+                if pix.alpha:
+                    continue
+                if pix.colorspace is None or pix.colorspace.n not in (1, 3):
+                    pix = fitz.Pixmap(fitz.csRGB, pix)
+                mode = "L" if pix.n == 1 else "RGB"
+                im = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+                pix = None
+            except Exception as e:
+                log.debug("skip image %s: %s", xref, e)
+                continue
+            # الدقة الفعلية = البكسلات ÷ بوصات العرض؛ نصغّر فقط ما يتجاوز الهدف
+            if it["dw"] > 0 and it["dh"] > 0:
+                scale = min(1.0, dpi / (im.width / (it["dw"] / 72.0)), dpi / (im.height / (it["dh"] / 72.0)))
+                if scale < 0.95:
+                    im = im.resize((max(1, int(im.width * scale)), max(1, int(im.height * scale))), Image.LANCZOS)
+            buf = io.BytesIO()
+            im.save(buf, "JPEG", quality=quality, optimize=True)
+            if buf.tell() < it["raw"] * 0.9:
+                data = buf.getvalue()
+                for x in it["xrefs"]:
+                    out[x] = data
+    return out
+
+def _apply_image_replacements(in_path: Path, out_path: Path, repl: Dict[int, bytes]):
+    with fitz.open(in_path.as_posix()) as doc:
+        page = doc[0]
+        for xref, data in repl.items():
+            page.replace_image(xref, stream=data)
+        doc.save(out_path.as_posix(), garbage=4, deflate=True, clean=True)
+
+# ======== العامل ========
+
+def serve(fd: int) -> None:
+    """يستقبل (fn, args) على الأنبوب وينفّذها حتى يُغلق الطرف الآخر أو يُقتل العامل."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    conn = Connection(fd)
+    while True:
+        try:
+            fn, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            conn.send(("ok", fn(*args)))
+        except BaseException as e:
+            try:
+                conn.send(("err", e))
+            except Exception:
+                conn.send(("err", RuntimeError(repr(e))))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    # الدوال تصل بمرجع cpu_tasks.<name>: نعمل من الوحدة المستوردة لا من __main__ حتى لا تُحمَّل مرتين
+    from cpu_tasks import serve as _serve
+    _serve(int(sys.argv[1]))
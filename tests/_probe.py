@@ -0,0 +1,5 @@
+import sys
+
+
+def loaded(name: str) -> bool:
+    return name in sys.modules
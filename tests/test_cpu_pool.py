@@ -0,0 +1,48 @@
+"""عمّال CPU_POOL (وضع process): يشغّلون cpu_tasks.py وحده بلا bot.py ولا telegram، ويُستبدل
+العامل بعد المهلة.
+
+    python -m pytest -q tests/test_cpu_pool.py
+"""
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import fitz
+
+TESTS = Path(__file__).resolve().parent
+sys.path.insert(0, str(TESTS.parent))
+import bot  # noqa: E402
+import cpu_tasks  # noqa: E402
+
+
+def test_process_workers_stay_light(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(TESTS))   # حتى يجد العامل _probe
+    monkeypatch.syspath_prepend(str(TESTS))
+    import _probe
+
+    pdf = tmp_path / "three.pdf"
+    with fitz.open() as doc:
+        for _ in range(3):
+            doc.new_page()
+        doc.save(pdf.as_posix())
+
+    pool = bot.CpuPool(1, "process")
+
+    async def main():
+        assert await pool.run(cpu_tasks._pdf_page_count, pdf, timeout=30) == 3
+        assert not await pool.run(_probe.loaded, "bot", timeout=30)
+        assert not await pool.run(_probe.loaded, "telegram", timeout=30)
+        first = pool._all[0].proc.pid
+        try:
+            await pool.run(time.sleep, 5, timeout=0.2)
+            raise AssertionError("timeout expected")
+        except asyncio.TimeoutError:
+            pass
+        assert pool._all[0].proc.pid != first
+        assert await pool.run(cpu_tasks._pdf_page_count, pdf, timeout=30) == 3
+
+    try:
+        asyncio.run(main())
+    finally:
+        pool.shutdown()
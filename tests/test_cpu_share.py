@@ -0,0 +1,52 @@
+"""حصة المهمة من مجمّع المعالج: المهام الفرعية لمهمة واحدة لا تتجاوز وحدات CPU التي منحها المجدول،
+فيجد الطلب الخفيف عاملاً فارغاً بينما يعمل مستند كبير.
+
+    python -m pytest -q tests/test_cpu_share.py
+"""
+import asyncio
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import bot  # noqa: E402
+
+
+def test_fanout_limited_to_grant(monkeypatch):
+    pool = bot.CpuPool(4, "thread")
+    monkeypatch.setattr(bot, "CPU_POOL", pool)
+    sched = bot.JobScheduler(8, 8192)
+    lock = threading.Lock()
+    state = {"now": 0, "peak": 0}
+
+    def heavy():
+        with lock:
+            state["now"] += 1
+            state["peak"] = max(state["peak"], state["now"])
+        time.sleep(0.05)
+        with lock:
+            state["now"] -= 1
+
+    async def big_doc():
+        async with sched.slot(1, "pdf", "pdf2docx"):      # 2.0 وحدة
+            assert bot.CPU_POOL.width() == 2
+            await asyncio.gather(*(bot.CPU_POOL.run(heavy) for _ in range(12)))
+
+    async def light():
+        await asyncio.sleep(0.02)
+        async with sched.slot(2, "image"):
+            t0 = time.monotonic()
+            await bot.CPU_POOL.run(time.sleep, 0)
+            return time.monotonic() - t0
+
+    async def main():
+        _, wait = await asyncio.gather(big_doc(), light())
+        return wait
+
+    try:
+        wait = asyncio.run(main())
+    finally:
+        pool.shutdown()
+    assert state["peak"] == 2
+    assert wait < 0.05   # لم ينتظر خلف 12 جزءاً
@@ -0,0 +1,140 @@
+"""fetch_url أمام خادم http.server محلي: الاستئناف بـ Range، حد الحجم، ورفض العناوين الداخلية.
+
+    python -m pytest -q tests/test_fetch_url.py
+"""
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import bot  # noqa: E402
+
+DATA = os.urandom(3_000_000)
+
+
+class Server:
+    """يخدم DATA مع دعم Range؛ cut_first يقطع أول استجابة في منتصفها، ويسجل الطلبات."""
+
+    def __init__(self, cut_first: bool = False, send_length: bool = True):
+        self.cut_first = cut_first
+        self.send_length = send_length
+        self.requests = []
+        srv = self
+
+        class H(BaseHTTPRequestHandler):
+            def log_message(self, *a):
+                pass
+
+            def do_GET(self):
+                rng = self.headers.get("Range")
+                srv.requests.append((rng, self.headers.get("Host")))
+                start = int(rng.split("=")[1].rstrip("-")) if rng else 0
+                body = DATA[start:]
+                self.send_response(206 if rng else 200)
+                if srv.send_length:
+                    self.send_header("Content-Length", str(len(body)))
+                self.send_header("Content-Disposition", 'attachment; filename="doc.pdf"')
+                self.send_header("Content-Type", "application/pdf")
+                self.end_headers()
+                if srv.cut_first and len(srv.requests) == 1:
+                    self.wfile.write(body[:1_000_000])
+                    self.wfile.flush()
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), H)
+        self.port = self.httpd.server_port
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _fetch(monkeypatch, url: str, limit: int, allow_private: bool = True):
+    monkeypatch.setattr(bot, "URL_ALLOW_PRIVATE", allow_private)
+    monkeypatch.setattr(bot, "URL_HTTP", None)   # عميل جديد لكل حلقة أحداث
+    dest = Path(tempfile.mkdtemp()) / "f"
+
+    async def run():
+        try:
+            return await bot.fetch_url(url, dest, limit)
+        finally:
+            await bot.URL_HTTP.aclose()
+
+    return asyncio.run(run()), dest
+
+
+def test_resume_with_range(monkeypatch):
+    srv = Server(cut_first=True)
+    sleep = bot.asyncio.sleep
+    monkeypatch.setattr(bot.asyncio, "sleep", lambda *_: sleep(0))
+    try:
+        (name, ctype), dest = _fetch(monkeypatch, f"http://127.0.0.1:{srv.port}/x", 10_000_000)
+    finally:
+        srv.close()
+    assert dest.read_bytes() == DATA
+    assert (name, ctype) == ("doc.pdf", "application/pdf")
+    assert srv.requests[0][0] is None and srv.requests[1][0].startswith("bytes=")
+
+
+def test_content_length_over_limit(monkeypatch):
+    srv = Server()
+    try:
+        with pytest.raises(bot.DownloadTooBig):
+            _fetch(monkeypatch, f"http://127.0.0.1:{srv.port}/x", 1000)
+    finally:
+        srv.close()
+
+
+def test_stream_over_limit_without_length(monkeypatch):
+    srv = Server(send_length=False)
+    try:
+        with pytest.raises(bot.DownloadTooBig):
+            _fetch(monkeypatch, f"http://127.0.0.1:{srv.port}/x", 100_000)
+    finally:
+        srv.close()
+
+
+def test_private_address_refused(monkeypatch):
+    srv = Server()
+    try:
+        with pytest.raises(RuntimeError, match="غير مسموح"):
+            _fetch(monkeypatch, f"http://127.0.0.1:{srv.port}/x", 10_000_000, allow_private=False)
+    finally:
+        srv.close()
+    assert srv.requests == []
+
+
+def test_connects_to_checked_address(monkeypatch):
+    # الاسم يُحل مرة واحدة لكل اتصال ويُتصل بالعنوان الناتج نفسه، وHost يبقى الاسم الأصلي
+    srv = Server()
+    calls = []
+    real = socket.getaddrinfo
+
+    def resolve(host, *a, **kw):
+        calls.append(host)
+        return real("127.0.0.1" if host == "files.test" else host, *a, **kw)
+
+    monkeypatch.setattr(socket, "getaddrinfo", resolve)
+    try:
+        _, dest = _fetch(monkeypatch, f"http://files.test:{srv.port}/x", 10_000_000)
+        rebound = None
+        try:
+            _fetch(monkeypatch, f"http://files.test:{srv.port}/x", 10_000_000, allow_private=False)
+        except RuntimeError as e:
+            rebound = e
+    finally:
+        srv.close()
+    assert dest.read_bytes() == DATA
+    assert calls == ["files.test", "files.test"]
+    assert srv.requests == [(None, f"files.test:{srv.port}")]
+    assert rebound is not None
@@ -0,0 +1,55 @@
+"""gc_sweep بعد إعادة التشغيل: مجلد النسخة السابقة (r<pid> بقفل حر) يحوي مهام الطابور الدائم،
+فلا يُحذف كاملاً؛ تُكنس البقايا فقط ويبقى مجلد المهمة المنتظرة.
+
+    python -m pytest -q tests/test_gc_sweep.py
+"""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import bot  # noqa: E402
+
+
+def _old(p: Path) -> Path:
+    t = time.time() - 10 * bot.GC_ORPHAN_AGE
+    os.utime(p, (t, t))
+    return p
+
+
+def test_dead_replica_keeps_queued_task(tmp_path, monkeypatch):
+    base = tmp_path / "convbot"
+    root = base / f"r{os.getpid()}"
+    root.mkdir(parents=True)
+    monkeypatch.setattr(bot, "WORK_BASE", base)
+    monkeypatch.setattr(bot, "WORK_ROOT", root)
+    monkeypatch.setattr(bot, "WORKQ", bot.WorkQueue((tmp_path / "queue.db").as_posix()))
+    monkeypatch.setattr(bot, "JOBS", bot.JobStore(bot.MemoryState(), bot.JOB_TTL))
+
+    dead = base / "r999999"
+    task_dir = dead / "u1_queued"
+    task_dir.mkdir(parents=True)
+    (task_dir / "in.pdf").write_bytes(b"%PDF-1.4")
+    (dead / ".lock").touch()                        # قفل بلا مالك: النسخة ماتت
+    stale = dead / "u2_stale"
+    stale.mkdir()
+    (stale / "left.bin").write_bytes(b"x" * 100)
+    for p in (task_dir, stale, dead):
+        _old(p)
+
+    job = bot.Job(1, "pdf", "fid", "in.pdf", file_path=task_dir / "in.pdf")
+    bot.WORKQ.submit(job, "conv:docx", 1, None)
+
+    asyncio.run(bot.gc_sweep())
+
+    assert (task_dir / "in.pdf").exists()
+    assert not stale.exists()
+    assert dead.exists()
+
+    # بعد انتهاء المهمة وتسليمها يُكنس مجلدها ثم مجلد النسخة الفارغ
+    bot.WORKQ._exec("UPDATE tasks SET state = 'delivered'")
+    asyncio.run(bot.gc_sweep())
+    assert not dead.exists()
+    assert root.exists()
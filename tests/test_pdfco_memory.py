@@ -0,0 +1,103 @@
+"""مسار PDF.co في office_to_pdf يبث الرفع والتنزيل من القرص وإليه: ذروة الذاكرة (tracemalloc)
+تبقى ثابتة مهما كبر الملف. خادم http.server محلي يحل محل api.pdf.co، ويرد 503 على أول رفع
+لتمر إعادة المحاولة أيضاً.
+
+    python -m pytest -q tests/test_pdfco_memory.py
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import bot  # noqa: E402
+
+MB = 1 << 20
+PEAK_LIMIT = 8 * MB   # الملفات أدناه 40–60MB؛ التحميل الكامل في الذاكرة يتجاوز هذا بكثير
+
+
+def _server(out_size: int):
+    calls = {"post": 0, "uploaded": 0}
+
+    class H(BaseHTTPRequestHandler):
+        def log_message(self, *a):
+            pass
+
+        def do_POST(self):
+            left = int(self.headers["Content-Length"])
+            while left:
+                left -= len(self.rfile.read(min(left, 1 << 16)))
+            calls["post"] += 1
+            if calls["post"] == 1:
+                self.send_response(503)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            calls["uploaded"] = int(self.headers["Content-Length"])
+            body = json.dumps({"success": True, "url": f"http://127.0.0.1:{httpd.server_port}/out"}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(out_size))
+            self.end_headers()
+            for _ in range(out_size // MB):
+                self.wfile.write(b"x" * MB)
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), H)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, calls
+
+
+def _convert(monkeypatch, in_size: int, out_size: int) -> int:
+    httpd, calls = _server(out_size)
+    tmp = Path(tempfile.mkdtemp())
+    src, dst = tmp / "big.docx", tmp / "out.pdf"
+    with src.open("wb") as f:
+        for _ in range(in_size // MB):
+            f.write(os.urandom(MB))
+
+    async def to_local(request: httpx.Request) -> None:
+        if request.url.host == "api.pdf.co":
+            request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=httpd.server_port)
+
+    monkeypatch.setitem(bot.BIN, "soffice", None)
+    monkeypatch.setattr(bot, "PDFCO_API_KEY", "test")
+
+    async def run() -> int:
+        monkeypatch.setattr(bot, "HTTP", httpx.AsyncClient(event_hooks={"request": [to_local]}))
+        try:
+            tracemalloc.start()
+            await bot.office_to_pdf(src, dst)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            await bot.HTTP.aclose()
+
+    try:
+        peak = asyncio.run(run())
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert calls["post"] == 2 and calls["uploaded"] > in_size
+    assert dst.stat().st_size == out_size
+    return peak
+
+
+def test_pdfco_memory_is_flat(monkeypatch):
+    small = _convert(monkeypatch, 4 * MB, 4 * MB)
+    large = _convert(monkeypatch, 60 * MB, 40 * MB)
+    print(f"peak: {small / MB:.1f}MB for 4MB, {large / MB:.1f}MB for 60MB in / 40MB out")
+    assert large < PEAK_LIMIT
+    assert large < small + 2 * MB
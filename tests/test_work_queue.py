@@ -0,0 +1,51 @@
+"""الطابور الدائم: ناتج انتهى لكن الواجهة ماتت قبل اكتمال رفعه يبقى 'delivering'، فتستلمه
+واجهة أخرى كيتيم وتعيد رفعه؛ ولا يصير 'delivered' إلا بعد نجاح الرفع.
+
+    python -m pytest -q tests/test_work_queue.py
+"""
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import bot  # noqa: E402
+
+
+def _finish(q: bot.WorkQueue, job: bot.Job, out: Path) -> Path:
+    async def run() -> Path:
+        task = asyncio.ensure_future(q.run(job, "conv:docx", 1, None))
+        while not q.waiting():
+            await asyncio.sleep(0.01)
+        tid = q.claim("w")[0]
+        q.finish(tid, "w", out.as_posix())
+        q.resolve(q.poll(q.waiting()))
+        return await task
+
+    return asyncio.run(run())
+
+
+def test_interrupted_upload_is_redelivered(tmp_path):
+    db = (tmp_path / "queue.db").as_posix()
+    job = bot.Job(1, "pdf", "fid", "in.pdf", file_path=tmp_path / "t" / "in.pdf")
+    dead = bot.WorkQueue(db)
+    out = _finish(dead, job, tmp_path / "t" / "out.docx")
+    assert dead.counts() == {"delivering": 1}
+    assert tmp_path / "t" in dead.live_dirs()
+
+    # الواجهة ماتت أثناء الرفع: نبضها قديم، وواجهة حيّة تستلم المهمة
+    dead._exec("UPDATE owners SET seen = 0")
+    live = bot.WorkQueue(db)
+    live._exec("INSERT INTO owners (owner, seen) VALUES (?, ?)", (live.owner, time.time()))
+    rows = live.claim_orphans()
+    assert [(r[1], r[6]) for r in rows] == [("delivering", out.as_posix())]
+    assert live.claim_orphans() == []
+
+
+def test_delivered_after_upload(tmp_path):
+    q = bot.WorkQueue((tmp_path / "queue.db").as_posix())
+    job = bot.Job(1, "pdf", "fid", "in.pdf", file_path=tmp_path / "t" / "in.pdf")
+    out = _finish(q, job, tmp_path / "t" / "out.docx")
+    assert q.counts() == {"delivering": 1}
+    asyncio.run(q.delivered(out))
+    assert q.counts() == {"delivered": 1}